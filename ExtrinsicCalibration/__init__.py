@@ -1,4 +1,4 @@
-from .extrinsicCalib import ExCalibrator
+from .extrinsicCalib import ExCalibrator, ExCalibConfig
 
 """
 Extrinsic Calibration
@@ -10,7 +10,11 @@ Instructions:
     homography = exCalib(src_raw, dst_raw)
     src_warp = exCalib.warp()
     
-You can edit parameters in the original file, or
+Parameters come from an ExCalibConfig, importing parses no command line
+    from extrinsicCalib import ExCalibrator, ExCalibConfig
+
+    exCalib = ExCalibrator(ExCalibConfig(BORAD_WIDTH=9, BORAD_HEIGHT=6))
+or edit the default config used when none is given
     args = ExCalibrator.get_args()
     args.INPUT_PATH = './ExtrinsicCalibration/data/'
     exCalib = ExCalibrator()
@@ -1,23 +1,74 @@
 import argparse
 import cv2
+import json
 import numpy as np
 import os
+import sys
+from dataclasses import dataclass, replace
 
-parser = argparse.ArgumentParser(description="Homography from Source to Destination Image")
-parser.add_argument('-id', '--CAMERA_ID', default=1, type=int, help='Camera ID')
-parser.add_argument('-path', '--INPUT_PATH', default='./data/', type=str, help='Input Source/Destination Image Path')
-parser.add_argument('-bw','--BORAD_WIDTH', default=7, type=int, help='Chess Board Width (corners number)')
-parser.add_argument('-bh','--BORAD_HEIGHT', default=6, type=int, help='Chess Board Height (corners number)')
-parser.add_argument('-src', '--SOURCE_IMAGE', default='img_src', type=str, help='Source Image File Name Prefix (eg.:img_src)')
-parser.add_argument('-dst', '--DEST_IMAGE', default='img_dst', type=str, help='Destionation Image File Name Prefix (eg.:img_dst)')
-parser.add_argument('-size','--SCALED_SIZE', default=10, type=int, help='Scaled Chess Board Square Size (image pixel)')
-parser.add_argument('-subpix_s','--SUBPIX_REGION_SRC', default=3, type=int, help='Corners Subpix Region of img_src')
-parser.add_argument('-subpix_d','--SUBPIX_REGION_DST', default=3, type=int, help='Corners Subpix Region of img_dst')
-parser.add_argument('-center','--CENTER_FLAG', default=False, type=bool, help='Center Image Manually (Ture/False)')
-parser.add_argument('-scale','--SCALE_FLAG', default=False, type=bool, help='Scale Image to Fix Board Size (Ture/False)')
-parser.add_argument('-store','--STORE_FLAG', default=False, type=bool, help='Store Centerd/Scaled Images (Ture/False)')
-parser.add_argument('-store_path', '--STORE_PATH', default='./data/', type=str, help='Path to Store Centerd/Scaled Images')
-args = parser.parse_args()
+if __package__ in (None, ''):
+    # run as a script from its own folder, the Tools package is in the repo root
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Tools.stageMetrics import metrics
+from Tools.calibBundle import update_bundle
+from Tools.chessboardDetect import find_chessboard
+from Tools.imageWriter import ImageWriter
+
+@dataclass
+class ExCalibConfig:
+    CAMERA_ID: int = 1
+    INPUT_PATH: str = './data/'
+    BORAD_WIDTH: int = 7
+    BORAD_HEIGHT: int = 6
+    SOURCE_IMAGE: str = 'img_src'
+    DEST_IMAGE: str = 'img_dst'
+    SCALED_SIZE: int = 10
+    SUBPIX_REGION_SRC: int = 3
+    SUBPIX_REGION_DST: int = 3
+    CENTER_FLAG: bool = False
+    SCALE_FLAG: bool = False
+    STORE_FLAG: bool = False
+    STORE_PATH: str = './data/'
+    METRICS_PATH: str = None
+    BUNDLE_PATH: str = None
+    CAMERA_NAME: str = None
+    DETECT_SCALE: float = 1
+    HEADLESS_FLAG: bool = False
+    VIS_PATH: str = None
+    RESULT_PATH: str = None
+
+def get_parser():
+    # defaults come from ExCalibConfig, parse_args fills the command line values into a config
+    parser = argparse.ArgumentParser(description="Homography from Source to Destination Image")
+    parser.add_argument('-id', '--CAMERA_ID', type=int, help='Camera ID')
+    parser.add_argument('-path', '--INPUT_PATH', type=str, help='Input Source/Destination Image Path')
+    parser.add_argument('-bw', '--BORAD_WIDTH', type=int, help='Chess Board Width (corners number)')
+    parser.add_argument('-bh', '--BORAD_HEIGHT', type=int, help='Chess Board Height (corners number)')
+    parser.add_argument('-src', '--SOURCE_IMAGE', type=str, help='Source Image File Name Prefix (eg.:img_src)')
+    parser.add_argument('-dst', '--DEST_IMAGE', type=str, help='Destionation Image File Name Prefix (eg.:img_dst)')
+    parser.add_argument('-size', '--SCALED_SIZE', type=int, help='Scaled Chess Board Square Size (image pixel)')
+    parser.add_argument('-subpix_s', '--SUBPIX_REGION_SRC', type=int, help='Corners Subpix Region of img_src')
+    parser.add_argument('-subpix_d', '--SUBPIX_REGION_DST', type=int, help='Corners Subpix Region of img_dst')
+    parser.add_argument('-center', '--CENTER_FLAG', type=bool, help='Center Image Manually (Ture/False)')
+    parser.add_argument('-scale', '--SCALE_FLAG', type=bool, help='Scale Image to Fix Board Size (Ture/False)')
+    parser.add_argument('-store', '--STORE_FLAG', type=bool, help='Store Centerd/Scaled Images (Ture/False)')
+    parser.add_argument('-store_path', '--STORE_PATH', type=str, help='Path to Store Centerd/Scaled Images')
+    parser.add_argument('-metrics', '--METRICS_PATH', type=str, help='Path to Write Stage Timing Metrics (.json or .prom, None to disable)')
+    parser.add_argument('-bundle', '--BUNDLE_PATH', type=str, help='Vehicle Calibration Bundle to Store H into (None to skip)')
+    parser.add_argument('-name', '--CAMERA_NAME', type=str, help='Camera Name in Bundle (eg.: front), None for Camera ID')
+    parser.add_argument('-detect_scale', '--DETECT_SCALE', type=float, help='Search Chessboard on Image Downscaled by this (1 for full resolution)')
+    parser.add_argument('-headless', '--HEADLESS_FLAG', type=bool, help='Run without Display Windows (Ture/False)')
+    parser.add_argument('-vis', '--VIS_PATH', type=str, help='Path to Write Source/Destination/Warped Images (None to skip)')
+    parser.add_argument('-result', '--RESULT_PATH', type=str, help='JSON File to Write Homographies (None to skip)')
+    parser.set_defaults(**vars(ExCalibConfig()))
+    return parser
+
+def parse_args(argv=None, config=None):
+    config = replace(config) if config is not None else ExCalibConfig()
+    return get_parser().parse_args(argv, namespace=config)
+
+# used when no config is given, see get_args
+default_config = ExCalibConfig()
 
 class CenterImage:
     def __init__(self):
@@ -85,17 +136,19 @@ class CenterImage:
             return self.raw_frame
 
 class ScaleImage:
-    def __init__(self, corners):        
+    def __init__(self, corners, config=None):
+        self.config = config if config is not None else default_config
         self.calc_dist(corners)
-        print('scale image from {} to {}'.format(self.dist_square,args.SCALED_SIZE))
-        self.scale_factor = args.SCALED_SIZE / self.dist_square
+        print('scale image from {} to {}'.format(self.dist_square,self.config.SCALED_SIZE))
+        self.scale_factor = self.config.SCALED_SIZE / self.dist_square
         
     def calc_dist(self, corners):
+        width, height = self.config.BORAD_WIDTH, self.config.BORAD_HEIGHT
         dist_total = 0
-        for i in range(args.BORAD_HEIGHT):
-            dist = cv2.norm(corners[i * args.BORAD_WIDTH,:], corners[(i+1) * args.BORAD_WIDTH-1,:], cv2.NORM_L2)
-            dist_total += dist / (args.BORAD_WIDTH - 1)
-        self.dist_square = dist_total / args.BORAD_HEIGHT
+        for i in range(height):
+            dist = cv2.norm(corners[i * width,:], corners[(i+1) * width-1,:], cv2.NORM_L2)
+            dist_total += dist / (width - 1)
+        self.dist_square = dist_total / height
 
     def padding(self, img, width, height):
         H = img.shape[0]
@@ -130,56 +183,85 @@ class ScaleImage:
         return raw_frame
 
 class ExCalibrator():
-    def __init__(self):
+    def __init__(self, config=None):
+        # config is copied, so changing the default config later does not affect this calibrator
+        self.config = replace(config if config is not None else default_config)
         self.src_corners_total = np.empty([0,1,2])
         self.dst_corners_total = np.empty([0,1,2])
+        self.pairs = 0
+        self.writer = None
 
     @staticmethod
     def get_args():
-        return args
+        # the default config, used by every ExCalibrator created without config=
+        return default_config
+
+    def show(self, window, img, name):
+        # window unless headless, and name.jpg under VIS_PATH written by a background thread
+        if self.config.VIS_PATH is not None:
+            if self.writer is None:
+                self.writer = ImageWriter(self.config.VIS_PATH)
+            self.writer.write('{}.jpg'.format(name), img)
+        if not self.config.HEADLESS_FLAG:
+            cv2.namedWindow(window, flags = cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
+            cv2.imshow(window, img)
+
+    def close(self):
+        # waits for the visualizations still being written
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
 
     def imgPreprocess(self, img, center, scale):
+        if center and self.config.HEADLESS_FLAG:
+            raise Exception("centering the image needs a display, center it before running headless")
         if center:
             centerImg = CenterImage()
             img = centerImg(img)
         if scale:
-            ok, corners = self.get_corners(img, subpix = args.SUBPIX_REGION_DST)
+            ok, corners = self.get_corners(img, subpix = self.config.SUBPIX_REGION_DST)
             if not ok:
                 raise Exception("failed to find corners in destination image")
-            scaleImg = ScaleImage(corners)
+            scaleImg = ScaleImage(corners, self.config)
             img = scaleImg(img)
-        cv2.imshow("Preprocessed Image", img)
-        cv2.waitKey(0)
+        self.show("Preprocessed Image", img, 'dst_preprocessed{}'.format(self.pairs))
+        if not self.config.HEADLESS_FLAG:
+            cv2.waitKey(0)
         return img
         
     def get_corners(self, img, subpix, draw=False):
-        ok, corners = cv2.findChessboardCorners(img, (args.BORAD_WIDTH, args.BORAD_HEIGHT),
-                      flags = cv2.CALIB_CB_ADAPTIVE_THRESH|cv2.CALIB_CB_NORMALIZE_IMAGE)
+        with metrics.stage('excalib.detect'):
+            ok, corners = find_chessboard(img, (self.config.BORAD_WIDTH, self.config.BORAD_HEIGHT),
+                          flags = cv2.CALIB_CB_ADAPTIVE_THRESH|cv2.CALIB_CB_NORMALIZE_IMAGE,
+                          scale = self.config.DETECT_SCALE, subpix = subpix)
+        metrics.count('excalib.images')
         if ok: 
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            corners = cv2.cornerSubPix(gray, corners, (subpix, subpix), (-1, -1),
-                                       (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01))
+            metrics.count('excalib.boards_found')
         if draw:
-            cv2.drawChessboardCorners(img, (args.BORAD_WIDTH, args.BORAD_HEIGHT), corners, ok)
+            with metrics.stage('excalib.draw'):
+                cv2.drawChessboardCorners(img, (self.config.BORAD_WIDTH, self.config.BORAD_HEIGHT), corners, ok)
         return ok, corners
     
     def warp(self):
-        src_warp = cv2.warpPerspective(self.src_img, self.homography, 
-                                       (self.dst_img.shape[1], self.dst_img.shape[0])) 
+        with metrics.stage('excalib.warp'):
+            src_warp = cv2.warpPerspective(self.src_img, self.homography, 
+                                           (self.dst_img.shape[1], self.dst_img.shape[0])) 
         return src_warp
         
     def __call__(self, src_img, dst_img):
-        ok, dst_corners = self.get_corners(dst_img, subpix = args.SUBPIX_REGION_DST, draw=True)
+        ok, dst_corners = self.get_corners(dst_img, subpix = self.config.SUBPIX_REGION_DST, draw=True)
         if not ok:
             raise Exception("failed to find corners in destination image")
-        ok, src_corners = self.get_corners(src_img, subpix = args.SUBPIX_REGION_SRC, draw=True)
+        ok, src_corners = self.get_corners(src_img, subpix = self.config.SUBPIX_REGION_SRC, draw=True)
         if not ok:
             raise Exception("failed to find corners in source image")
         self.dst_corners_total = np.append(self.dst_corners_total, dst_corners, axis = 0)
         self.src_corners_total = np.append(self.src_corners_total, src_corners, axis = 0)
-        self.homography, _ = cv2.findHomography(self.src_corners_total, self.dst_corners_total,method = cv2.RANSAC)
+        with metrics.stage('excalib.homography'):
+            self.homography, _ = cv2.findHomography(self.src_corners_total, self.dst_corners_total,method = cv2.RANSAC)
         self.src_img = src_img
         self.dst_img = dst_img
+        self.pairs += 1
         return self.homography    
 
 def get_images(PATH, NAME):
@@ -191,13 +273,17 @@ def get_images(PATH, NAME):
         raise Exception("from {} read images failed".format(PATH))
     return filenames
     
-def main():
+def main(args=None):
+    args = args if args is not None else parse_args()
+    if args.METRICS_PATH is not None:
+        metrics.enable()
     srcfiles = get_images(args.INPUT_PATH, args.SOURCE_IMAGE)
     dstfiles = get_images(args.INPUT_PATH, args.DEST_IMAGE)  
     if len(srcfiles) != len(dstfiles):
         raise Exception("numbers of source and destination images should be equal")
     
-    exCalib = ExCalibrator()
+    exCalib = ExCalibrator(args)
+    results = []
 
     for i in range(len(srcfiles)):    
         src_raw = cv2.imread(srcfiles[i])
@@ -213,21 +299,36 @@ def main():
         homography = exCalib(src_raw, dst_raw)
         print("Homography Matrix is:")
         print(homography.tolist())
+        results.append({'source': srcfiles[i], 'destination': dstfiles[i], 'homography': homography.tolist(),
+                        'bev_size': [dst_raw.shape[1], dst_raw.shape[0]]})
         np.save('camera_{}_H.npy'.format(args.CAMERA_ID), homography)
+        if args.METRICS_PATH is not None:
+            metrics.write(args.METRICS_PATH)
 
+        if args.HEADLESS_FLAG and args.VIS_PATH is None:
+            continue
         src_warp = exCalib.warp()
         
-        cv2.namedWindow("Source View", flags = cv2.WINDOW_NORMAL|cv2.WINDOW_KEEPRATIO)
-        cv2.imshow("Source View", src_raw)
-        cv2.namedWindow("Destination View", flags = cv2.WINDOW_NORMAL|cv2.WINDOW_KEEPRATIO)
-        cv2.imshow("Destination View", dst_raw)
-        cv2.namedWindow("Warped Source View", flags = cv2.WINDOW_NORMAL|cv2.WINDOW_KEEPRATIO)
-        cv2.imshow("Warped Source View", src_warp)
+        exCalib.show("Source View", src_raw, 'src{}'.format(i))
+        exCalib.show("Destination View", dst_raw, 'dst{}'.format(i))
+        exCalib.show("Warped Source View", src_warp, 'warped{}'.format(i))
         
-        while True:
-            key = cv2.waitKey(0)
-            if key == 27: break
-        cv2.destroyAllWindows()
+        if not args.HEADLESS_FLAG:
+            while True:
+                key = cv2.waitKey(0)
+                if key == 27: break
+            cv2.destroyAllWindows()
+    exCalib.close()
+    if args.BUNDLE_PATH is not None:
+        # the last homography is fitted to the corners of all pairs, so the bundle is written once
+        name = args.CAMERA_NAME if args.CAMERA_NAME is not None else str(args.CAMERA_ID)
+        update_bundle(args.BUNDLE_PATH, name, {'H': homography},
+                      {'bev_size': results[-1]['bev_size']}, drop=['bev1', 'bev2'])
+    if args.RESULT_PATH is not None:
+        # the last homography is fitted to the corners of all pairs
+        with open(args.RESULT_PATH, 'w') as f:
+            json.dump({'camera_id': args.CAMERA_ID, 'camera_name': args.CAMERA_NAME,
+                       'homography': results[-1]['homography'], 'pairs': results}, f, indent=2)
 
 
 if __name__ == '__main__':
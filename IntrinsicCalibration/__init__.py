@@ -1,4 +1,4 @@
-from .intrinsicCalib import InCalibrator, CalibMode
+from .intrinsicCalib import InCalibrator, CalibMode, InCalibConfig
 
 """
 Intrinsic Calibration
@@ -16,7 +16,32 @@ or
     calib = CalibMode(calibrator, input_type, mode)
     result = calib()
     
-You can edit parameters in the original file, or
+Image sets can be detected in a process pool and calibrated once instead of once per image
+    calib = CalibMode(calibrator, 'image', 'batch')
+    result = calib()
+or
+    detections = calibrator.detect(filenames, processes=4)     # [(ok, corners, image_size)]
+    result = calibrator.calibrate_views([c for ok, c, _ in detections if ok], image_size)
+
+Incremental calibration follows the RECALIB_INTERVAL/RECALIB_BUDGET/RECALIB_THRESH policy,
+call finish() to calibrate the views added since the last calibration
+    result = calibrator.finish()
+
+The worst view is dropped while its reprojection error is above PRUNE_THRESH x median, one per
+converged recalibration, in finish()/batch mode, result.dropped lists them as (view, error)
+
+Detected corners are cached by image hash when CORNER_CACHE is set,
+finish() (or CalibMode) saves them for the next run
+
+HEADLESS_FLAG runs the auto/batch modes without windows, VIS_PATH writes the shown frames to files,
+result.to_dict() gives a JSON friendly result
+
+Parameters come from an InCalibConfig, importing parses no command line
+    from intrinsicCalib import InCalibrator, InCalibConfig
+
+    config = InCalibConfig(INPUT_PATH='./IntrinsicCalibration/data/')
+    calibrator = InCalibrator(camera_type, config)
+or edit the default config used when none is given
     args = InCalibrator.get_args()
     args.INPUT_PATH = './IntrinsicCalibration/data/'
     calibrator = InCalibrator(camera_type)
@@ -1,32 +1,128 @@
 import argparse
 import cv2
+import hashlib
+import json
 import numpy as np
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
 
-parser = argparse.ArgumentParser(description="Camera Intrinsic Calibration")
-parser.add_argument('-input', '--INPUT_TYPE', default='camera', type=str, help='Input Source: camera/video/image')
-parser.add_argument('-type', '--CAMERA_TYPE', default='fisheye', type=str, help='Camera Type: fisheye/normal')
-parser.add_argument('-id', '--CAMERA_ID', default=1, type=int, help='Camera ID')
-parser.add_argument('-path', '--INPUT_PATH', default='./data/', type=str, help='Input Video/Image Path')
-parser.add_argument('-video', '--VIDEO_FILE', default='video.mp4', type=str, help='Input Video File Name (eg.: video.mp4)')
-parser.add_argument('-image', '--IMAGE_FILE', default='img_raw', type=str, help='Input Image File Name Prefix (eg.: img_raw)')
-parser.add_argument('-mode', '--SELECT_MODE', default='auto', type=str, help='Image Select Mode: auto/manual')
-parser.add_argument('-fw','--FRAME_WIDTH', default=1280, type=int, help='Camera Frame Width')
-parser.add_argument('-fh','--FRAME_HEIGHT', default=1024, type=int, help='Camera Frame Height')
-parser.add_argument('-bw','--BORAD_WIDTH', default=7, type=int, help='Chess Board Width (corners number)')
-parser.add_argument('-bh','--BORAD_HEIGHT', default=6, type=int, help='Chess Board Height (corners number)')
-parser.add_argument('-size','--SQUARE_SIZE', default=10, type=int, help='Chess Board Square Size (mm)')
-parser.add_argument('-num','--CALIB_NUMBER', default=5, type=int, help='Least Required Calibration Frame Number')
-parser.add_argument('-delay','--FRAME_DELAY', default=12, type=int, help='Capture Image Time Interval (frame number)')
-parser.add_argument('-subpix','--SUBPIX_REGION', default=5, type=int, help='Corners Subpix Optimization Region')
-parser.add_argument('-fps','--CAMERA_FPS', default=20, type=int, help='Camera Frame per Second(FPS)')
-parser.add_argument('-fs', '--FOCAL_SCALE', default=0.5, type=float, help='Camera Undistort Focal Scale')
-parser.add_argument('-ss', '--SIZE_SCALE', default=1, type=float, help='Camera Undistort Size Scale')
-parser.add_argument('-store','--STORE_FLAG', default=False, type=bool, help='Store Captured Images (Ture/False)')
-parser.add_argument('-store_path', '--STORE_PATH', default='./data/', type=str, help='Path to Store Captured Images')
-parser.add_argument('-crop','--CROP_FLAG', default=False, type=bool, help='Crop Input Video/Image to (fw,fh) (Ture/False)')
-parser.add_argument('-resize','--RESIZE_FLAG', default=False, type=bool, help='Resize Input Video/Image to (fw,fh) (Ture/False)')
-args = parser.parse_args()
+if __package__ in (None, ''):
+    # run as a script from its own folder, the Tools package is in the repo root
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Tools.stageMetrics import metrics
+from Tools.calibBundle import update_bundle
+from Tools.chessboardDetect import find_chessboard
+from Tools.frameGrabber import FrameGrabber
+from Tools.imageWriter import ImageWriter
+
+# criteria of one-shot calibrations over all views, the 30/10 iterations of the
+# per-view updates stop far from the optimum when started from scratch on many views
+CONVERGE_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 1000, 1e-9)
+
+@dataclass
+class InCalibConfig:
+    INPUT_TYPE: str = 'camera'
+    CAMERA_TYPE: str = 'fisheye'
+    CAMERA_ID: int = 1
+    INPUT_PATH: str = './data/'
+    VIDEO_FILE: str = 'video.mp4'
+    IMAGE_FILE: str = 'img_raw'
+    SELECT_MODE: str = 'auto'
+    FRAME_WIDTH: int = 1280
+    FRAME_HEIGHT: int = 1024
+    BORAD_WIDTH: int = 7
+    BORAD_HEIGHT: int = 6
+    SQUARE_SIZE: int = 10
+    CALIB_NUMBER: int = 5
+    FRAME_DELAY: int = 12
+    SUBPIX_REGION: int = 5
+    CAMERA_FPS: int = 20
+    FOCAL_SCALE: float = 0.5
+    SIZE_SCALE: float = 1
+    STORE_FLAG: bool = False
+    STORE_PATH: str = './data/'
+    CROP_FLAG: bool = False
+    RESIZE_FLAG: bool = False
+    METRICS_PATH: str = None
+    BUNDLE_PATH: str = None
+    CAMERA_NAME: str = None
+    PROCESSES: int = 0
+    RECALIB_INTERVAL: int = 1
+    RECALIB_BUDGET: float = 0
+    RECALIB_THRESH: float = 0
+    DETECT_SCALE: float = 1
+    CORNER_CACHE: str = None
+    SELECT_FLAG: bool = False
+    SELECT_GRID: int = 8
+    SELECT_CELLS: int = 3
+    SELECT_DIST: float = 0.2
+    SELECT_BUDGET: int = 30
+    PRUNE_THRESH: float = 0
+    PRUNE_ROUNDS: int = 3
+    CAPTURE_BUFFER: int = 4
+    HEADLESS_FLAG: bool = False
+    VIS_PATH: str = None
+    RESULT_PATH: str = None
+    MAX_FRAMES: int = 0
+
+def get_parser():
+    # defaults come from InCalibConfig, parse_args fills the command line values into a config
+    parser = argparse.ArgumentParser(description="Camera Intrinsic Calibration")
+    parser.add_argument('-input', '--INPUT_TYPE', type=str, help='Input Source: camera/video/image')
+    parser.add_argument('-type', '--CAMERA_TYPE', type=str, help='Camera Type: fisheye/normal')
+    parser.add_argument('-id', '--CAMERA_ID', type=int, help='Camera ID')
+    parser.add_argument('-path', '--INPUT_PATH', type=str, help='Input Video/Image Path')
+    parser.add_argument('-video', '--VIDEO_FILE', type=str, help='Input Video File Name (eg.: video.mp4)')
+    parser.add_argument('-image', '--IMAGE_FILE', type=str, help='Input Image File Name Prefix (eg.: img_raw)')
+    parser.add_argument('-mode', '--SELECT_MODE', type=str, help='Image Select Mode: auto/manual/batch')
+    parser.add_argument('-fw', '--FRAME_WIDTH', type=int, help='Camera Frame Width')
+    parser.add_argument('-fh', '--FRAME_HEIGHT', type=int, help='Camera Frame Height')
+    parser.add_argument('-bw', '--BORAD_WIDTH', type=int, help='Chess Board Width (corners number)')
+    parser.add_argument('-bh', '--BORAD_HEIGHT', type=int, help='Chess Board Height (corners number)')
+    parser.add_argument('-size', '--SQUARE_SIZE', type=int, help='Chess Board Square Size (mm)')
+    parser.add_argument('-num', '--CALIB_NUMBER', type=int, help='Least Required Calibration Frame Number')
+    parser.add_argument('-delay', '--FRAME_DELAY', type=int, help='Capture Image Time Interval (frame number)')
+    parser.add_argument('-subpix', '--SUBPIX_REGION', type=int, help='Corners Subpix Optimization Region')
+    parser.add_argument('-fps', '--CAMERA_FPS', type=int, help='Camera Frame per Second(FPS)')
+    parser.add_argument('-fs', '--FOCAL_SCALE', type=float, help='Camera Undistort Focal Scale')
+    parser.add_argument('-ss', '--SIZE_SCALE', type=float, help='Camera Undistort Size Scale')
+    parser.add_argument('-store', '--STORE_FLAG', type=bool, help='Store Captured Images (Ture/False)')
+    parser.add_argument('-store_path', '--STORE_PATH', type=str, help='Path to Store Captured Images')
+    parser.add_argument('-crop', '--CROP_FLAG', type=bool, help='Crop Input Video/Image to (fw,fh) (Ture/False)')
+    parser.add_argument('-resize', '--RESIZE_FLAG', type=bool, help='Resize Input Video/Image to (fw,fh) (Ture/False)')
+    parser.add_argument('-metrics', '--METRICS_PATH', type=str, help='Path to Write Stage Timing Metrics (.json or .prom, None to disable)')
+    parser.add_argument('-bundle', '--BUNDLE_PATH', type=str, help='Vehicle Calibration Bundle to Store K/D into (None to skip)')
+    parser.add_argument('-name', '--CAMERA_NAME', type=str, help='Camera Name in Bundle (eg.: front), None for Camera ID')
+    parser.add_argument('-processes', '--PROCESSES', type=int, help='Corner Detection Processes of Batch Mode (0 for CPU count)')
+    parser.add_argument('-recalib_every', '--RECALIB_INTERVAL', type=int, help='Recalibrate Every N Accepted Frames')
+    parser.add_argument('-recalib_budget', '--RECALIB_BUDGET', type=float, help='Max Fraction of Time Spent Recalibrating (0 for no limit)')
+    parser.add_argument('-recalib_thresh', '--RECALIB_THRESH', type=float, help='Stop Recalibrating when Relative Parameter Change is below (0 to never stop)')
+    parser.add_argument('-detect_scale', '--DETECT_SCALE', type=float, help='Search Chessboard on Image Downscaled by this (1 for full resolution)')
+    parser.add_argument('-corner_cache', '--CORNER_CACHE', type=str, help='Path to Cache Detected Corners of Images (None to disable)')
+    parser.add_argument('-select', '--SELECT_FLAG', type=bool, help='Only Accept Frames Adding Coverage or New Board Pose (Ture/False)')
+    parser.add_argument('-select_grid', '--SELECT_GRID', type=int, help='Coverage Grid Size (cells per side)')
+    parser.add_argument('-select_cells', '--SELECT_CELLS', type=int, help='Min New Coverage Cells to Accept a Frame')
+    parser.add_argument('-select_dist', '--SELECT_DIST', type=float, help='Min Board Pose Distance to Accept a Frame')
+    parser.add_argument('-select_budget', '--SELECT_BUDGET', type=int, help='Max Accepted Frames (0 for no limit)')
+    parser.add_argument('-prune', '--PRUNE_THRESH', type=float, help='Drop the Worst View while its Reprojection Error is above this x Median and Recalibrate (0 to disable)')
+    parser.add_argument('-prune_rounds', '--PRUNE_ROUNDS', type=int, help='Max Views Dropped, one per Recalibration')
+    parser.add_argument('-capture_buffer', '--CAPTURE_BUFFER', type=int, help='Camera Frames Buffered by Capture Thread (0 to read in main loop)')
+    parser.add_argument('-headless', '--HEADLESS_FLAG', type=bool, help='Run without Display Windows (Ture/False)')
+    parser.add_argument('-vis', '--VIS_PATH', type=str, help='Path to Write Visualized Frames (None to skip)')
+    parser.add_argument('-result', '--RESULT_PATH', type=str, help='JSON File to Write Calibration Result (None to skip)')
+    parser.add_argument('-max_frames', '--MAX_FRAMES', type=int, help='Max Frames Read in Video/Camera Auto Mode (0 for no limit)')
+    parser.set_defaults(**vars(InCalibConfig()))
+    return parser
+
+def parse_args(argv=None, config=None):
+    config = replace(config) if config is not None else InCalibConfig()
+    return get_parser().parse_args(argv, namespace=config)
+
+# used when no config is given, see get_args
+default_config = InCalibConfig()
 
 
 class CalibData:
@@ -39,174 +135,514 @@ class CalibData:
         self.map1 = None
         self.map2 = None
         self.reproj_err = None
+        self.image_size = None
+        self.dropped = []
         self.ok = False
 
+    def to_dict(self):
+        # JSON friendly result
+        errs = [float(err) for err in self.reproj_err] if self.reproj_err is not None else []
+        return {'type': self.type, 'ok': bool(self.ok),
+                'camera_mat': self.camera_mat.tolist() if self.camera_mat is not None else None,
+                'dist_coeff': self.dist_coeff.tolist() if self.dist_coeff is not None else None,
+                'image_size': [int(x) for x in self.image_size] if self.image_size is not None else None,
+                'views': len(errs), 'reproj_err': float(np.mean(errs)) if errs else None, 'view_reproj_err': errs,
+                'dropped': [[view, float(err)] for view, err in self.dropped]}
+
 class Fisheye:
-    def __init__(self):
+    def __init__(self, config=None):
+        self.config = config if config is not None else default_config
         self.data = CalibData()
         self.inited = False
-        self.BOARD = np.array([ [(j * args.SQUARE_SIZE, i * args.SQUARE_SIZE, 0.)]
-                               for i in range(args.BORAD_HEIGHT) 
-                               for j in range(args.BORAD_WIDTH) ],dtype=np.float32)
+        self.BOARD = np.array([ [(j * self.config.SQUARE_SIZE, i * self.config.SQUARE_SIZE, 0.)]
+                               for i in range(self.config.BORAD_HEIGHT) 
+                               for j in range(self.config.BORAD_WIDTH) ],dtype=np.float32)
         
-    def update(self, corners, frame_size):
+    def update(self, corners, frame_size, converge=False):
+        # converge: run the solver to convergence, for one-shot calibrations over all views
         board = [self.BOARD] * len(corners)
-        if not self.inited:
-            self._update_init(board, corners, frame_size)
-            self.inited = True
-        else:
-            self._update_refine(board, corners, frame_size)
-        self._calc_reproj_err(corners)
-        self._get_undistort_maps()
+        criteria = CONVERGE_CRITERIA if converge else None
+        with metrics.stage('incalib.calibrate'):
+            if not self.inited:
+                self._update_init(board, corners, frame_size, criteria)
+                self.inited = True
+            else:
+                self._update_refine(board, corners, frame_size, criteria)
+        with metrics.stage('incalib.reproj_err'):
+            self._calc_reproj_err(corners)
+        # rebuilt by get_undistort_maps when undistort is called
+        self.data.map1 = self.data.map2 = None
     
-    def _update_init(self, board, corners, frame_size):
+    def _update_init(self, board, corners, frame_size, criteria=None):
         data = self.data
         data.type = "FISHEYE"
         data.camera_mat = np.eye(3, 3)
         data.dist_coeff = np.zeros((4, 1))
+        flags = cv2.fisheye.CALIB_FIX_SKEW|cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC
+        if criteria is not None:
+            # started from its own guess the fisheye solver stalls far from the optimum on many view sets,
+            # a pinhole calibration of the same views is a much closer start
+            data.camera_mat = cv2.calibrateCamera(board, corners, frame_size, None, None, criteria=criteria)[1]
+            data.camera_mat[0, 1] = 0
+            flags |= cv2.fisheye.CALIB_USE_INTRINSIC_GUESS
         data.ok, data.camera_mat, data.dist_coeff, data.rvecs, data.tvecs = cv2.fisheye.calibrate(
-            board, corners, frame_size, data.camera_mat, data.dist_coeff,
-            flags=cv2.fisheye.CALIB_FIX_SKEW|cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC,
-            criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 1e-6)) 
-        data.ok = data.ok and cv2.checkRange(data.camera_mat) and cv2.checkRange(data.dist_coeff)
+            board, corners, frame_size, data.camera_mat, data.dist_coeff, flags=flags,
+            criteria=criteria or (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 1e-6)) 
+        # checkRange returns (ok, position of the first bad value)
+        data.ok = bool(data.ok) and cv2.checkRange(data.camera_mat)[0] and cv2.checkRange(data.dist_coeff)[0]
 
-    def _update_refine(self, board, corners, frame_size):
+    def _update_refine(self, board, corners, frame_size, criteria=None):
         data = self.data
         data.ok, data.camera_mat, data.dist_coeff, data.rvecs, data.tvecs = cv2.fisheye.calibrate(
             board, corners, frame_size, data.camera_mat, data.dist_coeff,
             flags=cv2.fisheye.CALIB_FIX_SKEW|cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC|cv2.CALIB_USE_INTRINSIC_GUESS,
-            criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 10, 1e-6))
-        data.ok = data.ok and cv2.checkRange(data.camera_mat) and cv2.checkRange(data.dist_coeff)
+            criteria=criteria or (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 10, 1e-6))
+        data.ok = bool(data.ok) and cv2.checkRange(data.camera_mat)[0] and cv2.checkRange(data.dist_coeff)[0]
 
     def _calc_reproj_err(self, corners):
         if not self.inited: return
         data = self.data
-        data.reproj_err = []
-        for i in range(len(corners)):
-            corners_reproj, _ = cv2.fisheye.projectPoints(self.BOARD, data.rvecs[i], data.tvecs[i], data.camera_mat, data.dist_coeff)
-            err = cv2.norm(corners_reproj, corners[i], cv2.NORM_L2) / len(corners_reproj)
-            data.reproj_err.append(err)
+        data.reproj_err = get_reproj_err(self.BOARD, corners, data.rvecs, data.tvecs, self._project)
+
+    def _project(self, points):
+        # cv2.fisheye.projectPoints of camera frame points, without its per point jacobians
+        camera_mat, dist_coeff = self.data.camera_mat, self.data.dist_coeff.ravel()
+        x, y = points[..., 0] / points[..., 2], points[..., 1] / points[..., 2]
+        r = np.sqrt(x * x + y * y)
+        theta = np.arctan(r)
+        theta2 = theta * theta
+        theta_d = theta * (1 + theta2 * (dist_coeff[0] + theta2 * (dist_coeff[1] + theta2 * (dist_coeff[2] + theta2 * dist_coeff[3]))))
+        scale = np.where(r > 1e-8, theta_d / np.maximum(r, 1e-8), 1.0)
+        return np.stack([camera_mat[0][0] * x * scale + camera_mat[0][2],
+                         camera_mat[1][1] * y * scale + camera_mat[1][2]], axis=-1)
             
     def _get_camera_mat_dst(self, camera_mat):
         camera_mat_dst = camera_mat.copy()
-        camera_mat_dst[0][0] *= args.FOCAL_SCALE
-        camera_mat_dst[1][1] *= args.FOCAL_SCALE
-        camera_mat_dst[0][2] = args.FRAME_WIDTH / 2 * args.SIZE_SCALE
-        camera_mat_dst[1][2] = args.FRAME_HEIGHT / 2 * args.SIZE_SCALE
+        camera_mat_dst[0][0] *= self.config.FOCAL_SCALE
+        camera_mat_dst[1][1] *= self.config.FOCAL_SCALE
+        camera_mat_dst[0][2] = self.config.FRAME_WIDTH / 2 * self.config.SIZE_SCALE
+        camera_mat_dst[1][2] = self.config.FRAME_HEIGHT / 2 * self.config.SIZE_SCALE
         return camera_mat_dst
     
-    def _get_undistort_maps(self):
+    def get_undistort_maps(self):
         data = self.data
+        c = self.config
         camera_mat_dst = self._get_camera_mat_dst(data.camera_mat)
         data.map1, data.map2 = cv2.fisheye.initUndistortRectifyMap(
                                  data.camera_mat, data.dist_coeff, np.eye(3, 3), camera_mat_dst, 
-                                 (int(args.FRAME_WIDTH * args.SIZE_SCALE), int(args.FRAME_HEIGHT * args.SIZE_SCALE)), cv2.CV_16SC2)
+                                 (int(c.FRAME_WIDTH * c.SIZE_SCALE), int(c.FRAME_HEIGHT * c.SIZE_SCALE)), cv2.CV_16SC2)
+
+def get_rotations(rvecs):
+    # Rodrigues formula for all rotation vectors at once
+    theta = np.linalg.norm(rvecs, axis=1)
+    k = rvecs / np.maximum(theta, 1e-12)[:, None]
+    cross = np.zeros((len(rvecs), 3, 3))
+    cross[:, 0, 1], cross[:, 0, 2], cross[:, 1, 2] = -k[:, 2], k[:, 1], -k[:, 0]
+    cross -= cross.transpose(0, 2, 1)
+    sin, cos = np.sin(theta)[:, None, None], np.cos(theta)[:, None, None]
+    return np.eye(3) + sin * cross + (1 - cos) * cross @ cross
+
+def get_reproj_err(board, corners, rvecs, tvecs, project):
+    # error of every view as cv2.norm(reprojected, corners) / number of corners, all views in one pass:
+    # boards moved into the camera frame by their poses, then projected together
+    rvecs = np.array(rvecs, dtype=np.float64).reshape(-1, 3)
+    tvecs = np.array(tvecs, dtype=np.float64).reshape(-1, 3)
+    board = board.reshape(-1, 3).astype(np.float64)
+    points = board @ get_rotations(rvecs).transpose(0, 2, 1) + tvecs[:, None, :]
+    diff = project(points) - np.array(corners, dtype=np.float64).reshape(len(rvecs), -1, 2)
+    return list(np.sqrt((diff ** 2).sum(axis=(1, 2))) / len(board))
 
 class Normal:
-    def __init__(self):
+    def __init__(self, config=None):
+        self.config = config if config is not None else default_config
         self.data = CalibData()
         self.inited = False
-        self.BOARD = np.array([ [(j * args.SQUARE_SIZE, i * args.SQUARE_SIZE, 0.)]
-                               for i in range(args.BORAD_HEIGHT) 
-                               for j in range(args.BORAD_WIDTH) ],dtype=np.float32)
+        self.BOARD = np.array([ [(j * self.config.SQUARE_SIZE, i * self.config.SQUARE_SIZE, 0.)]
+                               for i in range(self.config.BORAD_HEIGHT) 
+                               for j in range(self.config.BORAD_WIDTH) ],dtype=np.float32)
         
-    def update(self, corners, frame_size):
+    def update(self, corners, frame_size, converge=False):
+        # converge: run the solver to convergence, for one-shot calibrations over all views
         board = [self.BOARD] * len(corners)
-        if not self.inited:
-            self._update_init(board, corners, frame_size)
-            self.inited = True
-        else:
-            self._update_refine(board, corners, frame_size)
-        self._calc_reproj_err(corners)
-        self._get_undistort_maps()
+        criteria = CONVERGE_CRITERIA if converge else None
+        with metrics.stage('incalib.calibrate'):
+            if not self.inited:
+                self._update_init(board, corners, frame_size, criteria)
+                self.inited = True
+            else:
+                self._update_refine(board, corners, frame_size, criteria)
+        with metrics.stage('incalib.reproj_err'):
+            self._calc_reproj_err(corners)
+        # rebuilt by get_undistort_maps when undistort is called
+        self.data.map1 = self.data.map2 = None
         
-    def _update_init(self, board, corners, frame_size):
+    def _update_init(self, board, corners, frame_size, criteria=None):
         data = self.data
         data.type = "NORMAL"
         data.camera_mat = np.eye(3, 3)
         data.dist_coeff = np.zeros((5, 1))
         data.ok, data.camera_mat, data.dist_coeff, data.rvecs, data.tvecs = cv2.calibrateCamera(
             board, corners, frame_size, data.camera_mat, data.dist_coeff, 
-            criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 1e-6))
-        data.ok = data.ok and cv2.checkRange(data.camera_mat) and cv2.checkRange(data.dist_coeff)
+            criteria=criteria or (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 1e-6))
+        # checkRange returns (ok, position of the first bad value)
+        data.ok = bool(data.ok) and cv2.checkRange(data.camera_mat)[0] and cv2.checkRange(data.dist_coeff)[0]
         
-    def _update_refine(self, board, corners, frame_size):
+    def _update_refine(self, board, corners, frame_size, criteria=None):
         data = self.data
         data.ok, data.camera_mat, data.dist_coeff, data.rvecs, data.tvecs = cv2.calibrateCamera(
             board, corners, frame_size, data.camera_mat, data.dist_coeff,  
             flags = cv2.CALIB_USE_INTRINSIC_GUESS,
-            criteria=(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 10, 1e-6))
-        data.ok = data.ok and cv2.checkRange(data.camera_mat) and cv2.checkRange(data.dist_coeff)
+            criteria=criteria or (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 10, 1e-6))
+        data.ok = bool(data.ok) and cv2.checkRange(data.camera_mat)[0] and cv2.checkRange(data.dist_coeff)[0]
         
     def _calc_reproj_err(self, corners):
         if not self.inited: return
         data = self.data
-        data.reproj_err = []
-        for i in range(len(corners)):
-            corners_reproj, _ = cv2.projectPoints(self.BOARD, data.rvecs[i], data.tvecs[i], data.camera_mat, data.dist_coeff)
-            err = cv2.norm(corners_reproj, corners[i], cv2.NORM_L2) / len(corners_reproj)
-            data.reproj_err.append(err)
+        data.reproj_err = get_reproj_err(self.BOARD, corners, data.rvecs, data.tvecs, self._project)
+
+    def _project(self, points):
+        # cv2.projectPoints of camera frame points with k1 k2 p1 p2 k3, without its per point jacobians
+        camera_mat = self.data.camera_mat
+        k1, k2, p1, p2, k3 = self.data.dist_coeff.ravel()[:5]
+        x, y = points[..., 0] / points[..., 2], points[..., 1] / points[..., 2]
+        r2 = x * x + y * y
+        radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+        x_d = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+        y_d = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+        return np.stack([camera_mat[0][0] * x_d + camera_mat[0][2],
+                         camera_mat[1][1] * y_d + camera_mat[1][2]], axis=-1)
             
     def _get_camera_mat_dst(self, camera_mat):
         camera_mat_dst = camera_mat.copy()
-        camera_mat_dst[0][0] *= args.FOCAL_SCALE
-        camera_mat_dst[1][1] *= args.FOCAL_SCALE
-        camera_mat_dst[0][2] = args.FRAME_WIDTH / 2 * args.SIZE_SCALE
-        camera_mat_dst[1][2] = args.FRAME_HEIGHT / 2 * args.SIZE_SCALE
+        camera_mat_dst[0][0] *= self.config.FOCAL_SCALE
+        camera_mat_dst[1][1] *= self.config.FOCAL_SCALE
+        camera_mat_dst[0][2] = self.config.FRAME_WIDTH / 2 * self.config.SIZE_SCALE
+        camera_mat_dst[1][2] = self.config.FRAME_HEIGHT / 2 * self.config.SIZE_SCALE
         return camera_mat_dst
     
-    def _get_undistort_maps(self):
+    def get_undistort_maps(self):
         data = self.data
+        c = self.config
         camera_mat_dst = self._get_camera_mat_dst(data.camera_mat)
         data.map1, data.map2 = cv2.initUndistortRectifyMap(
                                  data.camera_mat, data.dist_coeff, np.eye(3, 3), camera_mat_dst, 
-                                 (int(args.FRAME_WIDTH * args.SIZE_SCALE), int(args.FRAME_HEIGHT * args.SIZE_SCALE)), cv2.CV_16SC2)
+                                 (int(c.FRAME_WIDTH * c.SIZE_SCALE), int(c.FRAME_HEIGHT * c.SIZE_SCALE)), cv2.CV_16SC2)
+
+class CornerCache:
+    VERSION = 3
+
+    def __init__(self, path):
+        # detections by key, saved as all corners and a JSON index into them in a single corners.npz,
+        # which is replaced as a whole so the index always matches the corners
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        os.makedirs(self.path, exist_ok=True)
+        self.load()
+
+    def get_key(self, kind, data, config):
+        # kind 'image' hashes the pixels of a frame, 'file' the bytes of an image file before decoding and preprocessing
+        params = [config.BORAD_WIDTH, config.BORAD_HEIGHT, config.SUBPIX_REGION, config.DETECT_SCALE]
+        if kind == 'file':
+            params += [config.CROP_FLAG, config.RESIZE_FLAG, config.FRAME_WIDTH, config.FRAME_HEIGHT]
+        sha = hashlib.sha1(repr((self.VERSION, kind, params)).encode())
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data)
+            sha.update(str((data.dtype.str, data.shape)).encode())
+        sha.update(data)
+        return sha.hexdigest()
+
+    def get(self, key):
+        detection = self.entries.get(key)
+        metrics.count('incalib.corner_cache_hits' if detection is not None else 'incalib.corner_cache_misses')
+        return detection
+
+    def put(self, key, detection):
+        self.entries[key] = detection
+        self.dirty = True
+
+    def read(self):
+        try:
+            with np.load(os.path.join(self.path, 'corners.npz')) as data:
+                index = json.loads(str(data['index']))
+                corners = data['corners']
+        except (OSError, ValueError, KeyError):
+            return {}
+        if index.get('version') != self.VERSION:
+            return {}
+        entries = {}
+        for key, (ok, offset, count, size) in index['entries'].items():
+            found = corners[offset:offset + count].reshape(-1, 1, 2) if ok else None
+            entries[key] = (ok, found, tuple(size))
+        return entries
+
+    def load(self):
+        self.entries.update(self.read())
+
+    def save(self):
+        if not self.dirty:
+            return
+        # keeps what another run saved since this one loaded
+        self.entries = {**self.read(), **self.entries}
+        index = {}
+        blocks = []
+        offset = 0
+        for key, (ok, corners, size) in self.entries.items():
+            count = len(corners) if ok else 0
+            index[key] = [bool(ok), offset, count, [int(x) for x in size]]
+            if ok:
+                blocks.append(np.asarray(corners, dtype=np.float32).reshape(-1, 2))
+            offset += count
+        corners = np.concatenate(blocks) if blocks else np.zeros((0, 2), dtype=np.float32)
+        tmp = os.path.join(self.path, 'corners.tmp{}.npz'.format(os.getpid()))
+        np.savez(tmp, corners=corners, index=np.array(json.dumps({'version': self.VERSION, 'entries': index})))
+        os.replace(tmp, os.path.join(self.path, 'corners.npz'))
+        self.dirty = False
+
+class FrameSelector:
+    def __init__(self, config):
+        # corners per cell of a coverage grid over the image, and the (x, y, size, skew) pose of every accepted board
+        self.config = config
+        self.grid = np.zeros((config.SELECT_GRID, config.SELECT_GRID), dtype=np.int32)
+        self.poses = []
+
+    def get_cells(self, points, image_size):
+        cells = (points / np.array(image_size) * self.config.SELECT_GRID).astype(np.int32)
+        cells = np.clip(cells, 0, self.config.SELECT_GRID - 1)
+        return np.unique(cells[:, 1] * self.config.SELECT_GRID + cells[:, 0])
+
+    def get_pose(self, points, image_size):
+        # board center, sqrt of its image area fraction, and how far its corner angle is from 90 degrees
+        width, height = self.config.BORAD_WIDTH, self.config.BORAD_HEIGHT
+        outer = points[[0, width - 1, width * height - 1, width * (height - 1)]]
+        x, y = points.mean(axis=0) / np.array(image_size)
+        size = np.sqrt(cv2.contourArea(outer.astype(np.float32)) / (image_size[0] * image_size[1]))
+        right, down = outer[1] - outer[0], outer[3] - outer[0]
+        cos = np.dot(right, down) / (np.linalg.norm(right) * np.linalg.norm(down))
+        skew = min(1.0, 2 * abs(np.pi / 2 - np.arccos(np.clip(cos, -1, 1))))
+        return np.array([x, y, size, skew])
+
+    def __call__(self, corners, image_size):
+        if self.config.SELECT_BUDGET > 0 and len(self.poses) >= self.config.SELECT_BUDGET:
+            return False
+        points = corners.reshape(-1, 2)
+        cells = self.get_cells(points, image_size)
+        pose = self.get_pose(points, image_size)
+        new_cells = np.count_nonzero(self.grid.flat[cells] == 0)
+        dist = min(np.abs(pose - other).sum() for other in self.poses) if self.poses else np.inf
+        if new_cells < self.config.SELECT_CELLS and dist < self.config.SELECT_DIST:
+            return False
+        self.grid.flat[cells] += 1
+        self.poses.append(pose)
+        return True
+
+    def coverage(self):
+        return np.count_nonzero(self.grid) / self.grid.size
 
 class InCalibrator:
-    def __init__(self, camera):
+    def __init__(self, camera, config=None):
+        # config is copied, so changing the default config later does not affect this calibrator
+        self.config = replace(config if config is not None else default_config)
         if camera == 'fisheye':
-            self.camera = Fisheye()
+            self.camera = Fisheye(self.config)
         elif camera == 'normal':
-            self.camera = Normal()
+            self.camera = Normal(self.config)
         else:
             raise Exception("camera should be fisheye/normal")
         self.corners = []
+        self.views = []
+        self.frames = 0
+        self.pending = 0
+        self.converged = False
+        self.calib_time = 0
+        self.calib_end = 0
+        self.detection = None
+        self.selector = FrameSelector(self.config) if self.config.SELECT_FLAG else None
+        self.cache = CornerCache(self.config.CORNER_CACHE) if self.config.CORNER_CACHE is not None else None
 
     @staticmethod
     def get_args():
-        return args
+        # the default config, used by every InCalibrator created without config=
+        return default_config
 
     def get_corners(self, img):
-        ok, corners = cv2.findChessboardCorners(img, (args.BORAD_WIDTH, args.BORAD_HEIGHT),
-                      flags = cv2.CALIB_CB_ADAPTIVE_THRESH|cv2.CALIB_CB_NORMALIZE_IMAGE|cv2.CALIB_CB_FAST_CHECK)
-        if ok: 
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            corners = cv2.cornerSubPix(gray, corners, (args.SUBPIX_REGION, args.SUBPIX_REGION), (-1, -1),
-                                       (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01))
-        return ok, corners
+        if self.cache is None:
+            return find_corners(img, self.config)
+        key = self.cache.get_key('image', img, self.config)
+        detection = self.cache.get(key)
+        if detection is None:
+            ok, corners = find_corners(img, self.config)
+            detection = (ok, corners, img.shape[1::-1])
+            self.cache.put(key, detection)
+        return detection[:2]
+
+    def detect(self, filenames, processes=None):
+        # (ok, corners, image size) of every image, each pool process reads and searches its own images
+        processes = processes if processes is not None else self.config.PROCESSES
+        processes = processes if processes > 0 else os.cpu_count()
+        detections = [None] * len(filenames)
+        keys = [None] * len(filenames)
+        if self.cache is not None:
+            # cached files are only hashed, not decoded
+            for i, filename in enumerate(filenames):
+                with open(filename, 'rb') as f:
+                    keys[i] = self.cache.get_key('file', f.read(), self.config)
+                detections[i] = self.cache.get(keys[i])
+        missing = [i for i, detection in enumerate(detections) if detection is None]
+        files = [filenames[i] for i in missing]
+        configs = [self.config] * len(files)
+        if processes == 1 or len(files) <= 1:
+            found = list(map(detect_image, files, configs))
+        else:
+            with ProcessPoolExecutor(min(processes, len(files))) as executor:
+                chunksize = max(1, len(files) // (4 * processes))
+                found = list(executor.map(detect_image, files, configs, chunksize=chunksize))
+        for i, detection in zip(missing, found):
+            detections[i] = detection
+            if self.cache is not None:
+                self.cache.put(keys[i], detection)
+        if self.cache is not None:
+            self.cache.save()
+        return detections
+
+    def calibrate_views(self, corners, image_size, views=None):
+        # single calibration over all given views, instead of one per added view
+        # views: names of the views (eg. file names) reported when they are pruned
+        self.corners = list(corners)
+        self.views = list(views) if views is not None else list(range(len(self.corners)))
+        self.pending = len(self.corners)
+        self.calibrate(image_size=tuple(image_size), converge=True)
+        return self.prune()
+
+    def prune(self):
+        # drop the worst view if its error is above PRUNE_THRESH x median and recalibrate, at most PRUNE_ROUNDS times
+        # the errors must come from a converged calibration, one view is dropped per round as
+        # the errors of the others change once it is gone
+        c = self.config
+        data = self.camera.data
+        if c.PRUNE_THRESH <= 0 or not self.camera.inited:
+            return data
+        for _ in range(c.PRUNE_ROUNDS):
+            errs = np.array(data.reproj_err)
+            worst = int(np.argmax(errs))
+            if errs[worst] <= c.PRUNE_THRESH * np.median(errs) or len(errs) - 1 < c.CALIB_NUMBER:
+                break
+            data.dropped.append((self.views[worst], float(errs[worst])))
+            del self.corners[worst], self.views[worst]
+            metrics.count('incalib.views_pruned')
+            with metrics.stage('incalib.prune'):
+                self.calibrate(image_size=data.image_size, converge=True)
+        return data
     
-    def draw_corners(self, img):
-        ok, corners = self.get_corners(img)
-        cv2.drawChessboardCorners(img, (args.BORAD_WIDTH, args.BORAD_HEIGHT), corners, ok)
+    def draw_corners(self, img, detection=None):
+        # detection: (ok, corners) already found in img, eg. self.detection after calling the calibrator
+        ok, corners = detection if detection is not None else self.get_corners(img)
+        with metrics.stage('incalib.draw'):
+            cv2.drawChessboardCorners(img, (self.config.BORAD_WIDTH, self.config.BORAD_HEIGHT), corners, ok)
         return img
     
     def undistort(self, img):
         data = self.camera.data
-        return cv2.remap(img, data.map1, data.map2, cv2.INTER_LINEAR)
+        if data.map1 is None:
+            with metrics.stage('incalib.undistort_maps'):
+                self.camera.get_undistort_maps()
+        with metrics.stage('incalib.undistort'):
+            return cv2.remap(img, data.map1, data.map2, cv2.INTER_LINEAR)
     
-    def calibrate(self, img):
-        if len(self.corners) >= args.CALIB_NUMBER:
-            self.camera.update(self.corners, img.shape[1::-1])
-        return self.camera.data
+    def calibrate(self, img=None, image_size=None, converge=False):
+        # calibrate over all corners now, regardless of the recalibration policy
+        # converge: run the solver to convergence instead of the few iterations of a per-view update
+        image_size = image_size if image_size is not None else img.shape[1::-1]
+        if len(self.corners) < self.config.CALIB_NUMBER:
+            return self.camera.data
+        data = self.camera.data
+        inited = self.camera.inited
+        if inited:
+            # cv2 calibration writes into the given intrinsics
+            camera_mat, dist_coeff = data.camera_mat.copy(), data.dist_coeff.copy()
+        start = time.perf_counter()
+        self.camera.update(self.corners, image_size, converge)
+        self.calib_end = time.perf_counter()
+        self.calib_time = self.calib_end - start
+        data.image_size = image_size
+        self.pending = 0
+        if inited and self.config.RECALIB_THRESH > 0:
+            self.converged = get_param_change(camera_mat, dist_coeff, data) < self.config.RECALIB_THRESH
+            if self.converged:
+                metrics.count('incalib.converged')
+        return data
+
+    def need_calibrate(self):
+        # recalibration policy: every RECALIB_INTERVAL new views, within the time budget, until converged
+        c = self.config
+        if len(self.corners) < c.CALIB_NUMBER:
+            return False
+        if not self.camera.inited:
+            return True
+        if self.converged or self.pending < c.RECALIB_INTERVAL:
+            return False
+        if c.RECALIB_BUDGET > 0 and self.calib_time > c.RECALIB_BUDGET * (time.perf_counter() - self.calib_end):
+            return False
+        return True
+
+    def finish(self):
+        # one last calibration if views were added since the last one, run to convergence before pruning
+        if self.cache is not None:
+            self.cache.save()
+        if self.camera.inited and (self.pending > 0 or self.config.PRUNE_THRESH > 0):
+            self.calibrate(image_size=self.camera.data.image_size, converge=self.config.PRUNE_THRESH > 0)
+        return self.prune()
     
-    def __call__(self, raw_frame):
-        ok, corners = self.get_corners(raw_frame)
+    def __call__(self, raw_frame, detection=None):
+        ok, corners = detection if detection is not None else self.get_corners(raw_frame)
+        self.detection = (ok, corners)
+        self.frames += 1
         result = self.camera.data
+        if ok and self.selector is not None and not self.selector(corners, raw_frame.shape[1::-1]):
+            metrics.count('incalib.frames_rejected')
+            return result
         if ok:
             self.corners.append(corners)
-            result = self.calibrate(raw_frame)
+            self.views.append(self.frames - 1)
+            self.pending += 1
+            if self.need_calibrate():
+                result = self.calibrate(raw_frame)
+            else:
+                metrics.count('incalib.recalib_skipped')
         return result
 
+def get_param_change(camera_mat, dist_coeff, data):
+    # relative change of the intrinsics between two calibrations
+    change_mat = np.linalg.norm(data.camera_mat - camera_mat) / np.linalg.norm(camera_mat)
+    change_dist = np.linalg.norm(data.dist_coeff - dist_coeff) / (np.linalg.norm(dist_coeff) + 1)
+    return max(change_mat, change_dist)
+
+def find_corners(img, config):
+    with metrics.stage('incalib.detect'):
+        ok, corners = find_chessboard(img, (config.BORAD_WIDTH, config.BORAD_HEIGHT),
+                      flags = cv2.CALIB_CB_ADAPTIVE_THRESH|cv2.CALIB_CB_NORMALIZE_IMAGE|cv2.CALIB_CB_FAST_CHECK,
+                      scale = config.DETECT_SCALE, subpix = config.SUBPIX_REGION)
+    metrics.count('incalib.frames')
+    if ok: 
+        metrics.count('incalib.boards_found')
+    return ok, corners
+
+def detect_image(filename, config):
+    # runs in a pool process of InCalibrator.detect, only the corners are sent back
+    img = cv2.imread(filename)
+    if img is None:
+        raise Exception("read image {} failed".format(filename))
+    img = preprocess(img, config)
+    ok, corners = find_corners(img, config)
+    return ok, corners, img.shape[1::-1]
+
+def preprocess(img, config):
+    if config.CROP_FLAG:
+        img = centerCrop(img, config.FRAME_WIDTH, config.FRAME_HEIGHT)
+    elif config.RESIZE_FLAG:
+        img = cv2.resize(img, (config.FRAME_WIDTH, config.FRAME_HEIGHT))
+    return img
+
 def centerCrop(img,width,height):
     if img.shape[1] < width or img.shape[0] < height:
         raise Exception("CROP size should be smaller than original size")
@@ -224,167 +660,241 @@ def get_images(PATH, NAME):
     return filenames
 
 class CalibMode():
-    def __init__(self, calibrator, input_type, mode):
+    def __init__(self, calibrator, input_type, mode, config=None):
+        self.config = config if config is not None else calibrator.config
         self.calibrator = calibrator
         self.input_type = input_type
         self.mode = mode
+        self.writer = None
+        self.vis_id = 0
+
+    def show(self, name, img):
+        # window unless headless, and a numbered file under VIS_PATH written by a background thread
+        if self.config.VIS_PATH is not None:
+            if self.writer is None:
+                self.writer = ImageWriter(self.config.VIS_PATH)
+            self.writer.write('{}_{:05d}.jpg'.format(name, self.vis_id), img)
+        if not self.config.HEADLESS_FLAG:
+            cv2.namedWindow(name, flags = cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
+            cv2.imshow(name, img)
+
+    def waitKey(self, delay):
+        # no GUI event loop when headless
+        return -1 if self.config.HEADLESS_FLAG else cv2.waitKey(delay)
+
+    def closeWindows(self):
+        if not self.config.HEADLESS_FLAG:
+            cv2.destroyAllWindows()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
     
     def imgPreprocess(self, img):
-        if args.CROP_FLAG:
-            img = centerCrop(img, args.FRAME_WIDTH, args.FRAME_HEIGHT)
-        elif args.RESIZE_FLAG:
-            img = cv2.resize(img, (args.FRAME_WIDTH, args.FRAME_HEIGHT))
-        return img
+        with metrics.stage('calibmode.preprocess'):
+            return preprocess(img, self.config)
     
     def setCamera(self, cap):
         cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc('M','J','P','G'))
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, args.FRAME_WIDTH)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, args.FRAME_HEIGHT)
-        cap.set(cv2.CAP_PROP_FPS, args.CAMERA_FPS)
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.config.FRAME_WIDTH)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.config.FRAME_HEIGHT)
+        cap.set(cv2.CAP_PROP_FPS, self.config.CAMERA_FPS)
+        return cap
+
+    def openCamera(self):
+        cap = cv2.VideoCapture(self.config.CAMERA_ID)
+        if not cap.isOpened(): 
+            raise Exception("from {} read video failed".format(self.config.CAMERA_ID))
+        cap = self.setCamera(cap)
+        if self.config.CAPTURE_BUFFER > 0:
+            # read in a capture thread, the driver only needs to hold the newest frame
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            cap = FrameGrabber(cap, self.config.CAPTURE_BUFFER)
         return cap
 
-    def runCalib(self, raw_frame, display_raw=True, display_undist=True):
+    def closeCamera(self, cap):
+        cap.release()
+        if isinstance(cap, FrameGrabber):
+            print("{} frames captured, {} dropped".format(cap.captured, cap.dropped))
+
+    def runCalib(self, raw_frame, display_raw=True, display_undist=True, detection=None):
         calibrator = self.calibrator
-        raw_frame = self.imgPreprocess(raw_frame)
-        result = calibrator(raw_frame)
-        raw_frame = calibrator.draw_corners(raw_frame)
-        if display_raw:
-            cv2.namedWindow("raw_frame", flags = cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
-            cv2.imshow("raw_frame", raw_frame)
-        if len(calibrator.corners) > args.CALIB_NUMBER and display_undist: 
-            undist_frame = calibrator.undistort(raw_frame)
-            cv2.namedWindow("undist_frame", flags = cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
-            cv2.imshow("undist_frame", undist_frame)   
-        cv2.waitKey(1)
+        with metrics.stage('calibmode.frame'):
+            raw_frame = self.imgPreprocess(raw_frame)
+            result = calibrator(raw_frame, detection)
+        if self.config.HEADLESS_FLAG and self.config.VIS_PATH is None:
+            # nothing is shown or written
+            return result
+        with metrics.stage('calibmode.display'):
+            raw_frame = calibrator.draw_corners(raw_frame, calibrator.detection)
+            if display_raw:
+                self.show("raw_frame", raw_frame)
+            if len(calibrator.corners) > self.config.CALIB_NUMBER and display_undist: 
+                self.show("undist_frame", calibrator.undistort(raw_frame))
+            self.waitKey(1)
+        self.vis_id += 1
         return result
     
     def imageAutoMode(self):
-        filenames = get_images(args.INPUT_PATH, args.IMAGE_FILE)
+        filenames = get_images(self.config.INPUT_PATH, self.config.IMAGE_FILE)
         for filename in filenames:
             print(filename)
-            raw_frame = cv2.imread(filename)
+            with metrics.stage('calibmode.read'):
+                raw_frame = cv2.imread(filename)
             result = self.runCalib(raw_frame)
-            key = cv2.waitKey(1)
+            key = self.waitKey(1)
             if key == 27: break
-        cv2.destroyAllWindows() 
+        self.closeWindows() 
         return result
     
+    def imageBatchMode(self):
+        # corners of all images in parallel, then one calibration over the views with a board
+        filenames = get_images(self.config.INPUT_PATH, self.config.IMAGE_FILE)
+        with metrics.stage('calibmode.batch_detect'):
+            detections = self.calibrator.detect(filenames)
+        views = [(filename, corners, size) for filename, (ok, corners, size) in zip(filenames, detections) if ok]
+        print("chessboard found in {} of {} images".format(len(views), len(filenames)))
+        selector = self.calibrator.selector
+        if selector is not None:
+            views = [(filename, corners, size) for filename, corners, size in views if selector(corners, size)]
+            print("{} images selected, coverage {:.0%}".format(len(views), selector.coverage()))
+        if len(views) == 0:
+            return self.calibrator.camera.data
+        if len(set(size for _, _, size in views)) > 1:
+            raise Exception("all calibration images should have the same size, set -crop or -resize")
+        return self.calibrator.calibrate_views([corners for _, corners, _ in views], views[0][2],
+                                               [filename for filename, _, _ in views])
+
     def imageManualMode(self):
-        filenames = get_images(args.INPUT_PATH, args.IMAGE_FILE)
+        filenames = get_images(self.config.INPUT_PATH, self.config.IMAGE_FILE)
         for filename in filenames:
             print(filename)
-            raw_frame = cv2.imread(filename)
+            with metrics.stage('calibmode.read'):
+                raw_frame = cv2.imread(filename)
             raw_frame = self.imgPreprocess(raw_frame)
-            img = raw_frame.copy()
-            img = self.calibrator.draw_corners(img)
+            detection = self.calibrator.get_corners(raw_frame)
+            img = self.calibrator.draw_corners(raw_frame.copy(), detection)
             display = "raw_frame: press SPACE to SELECT, other key to SKIP, press ESC to QUIT"
             cv2.namedWindow(display, flags = cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
             cv2.imshow(display, img)
             key = cv2.waitKey(0)
             if key == 32:
-                result = self.runCalib(raw_frame, display_raw = False)
+                result = self.runCalib(raw_frame, display_raw = False, detection = detection)
             if key == 27: break
-        cv2.destroyAllWindows() 
+        self.closeWindows() 
         return result
     
     def videoAutoMode(self):
-        cap = cv2.VideoCapture(args.INPUT_PATH + args.VIDEO_FILE)
+        cap = cv2.VideoCapture(self.config.INPUT_PATH + self.config.VIDEO_FILE)
         if not cap.isOpened(): 
-            raise Exception("from {} read video failed".format(args.INPUT_PATH + args.VIDEO_FILE))
+            raise Exception("from {} read video failed".format(self.config.INPUT_PATH + self.config.VIDEO_FILE))
         frame_id = 0
-        while True:
-            ok, raw_frame = cap.read()
+        result = self.calibrator.camera.data
+        while self.config.MAX_FRAMES <= 0 or frame_id < self.config.MAX_FRAMES:
+            with metrics.stage('calibmode.read'):
+                ok, raw_frame = cap.read()
+            if not ok: break
             raw_frame = self.imgPreprocess(raw_frame)
-            if frame_id % args.FRAME_DELAY == 0:
-                if args.STORE_FLAG:
-                    cv2.imwrite(args.STORE_PATH + 'img_raw{}.jpg'.format(len(self.calibrator.corners)), raw_frame)
+            if frame_id % self.config.FRAME_DELAY == 0:
+                if self.config.STORE_FLAG:
+                    cv2.imwrite(self.config.STORE_PATH + 'img_raw{}.jpg'.format(len(self.calibrator.corners)), raw_frame)
                 result = self.runCalib(raw_frame) 
                 print(len(self.calibrator.corners))
             frame_id += 1 
-            key = cv2.waitKey(1)
+            key = self.waitKey(1)
             if key == 27: break
         cap.release()
-        cv2.destroyAllWindows() 
+        self.closeWindows() 
         return result
     
     def videoManualMode(self):
-        cap = cv2.VideoCapture(args.INPUT_PATH + args.VIDEO_FILE)
+        cap = cv2.VideoCapture(self.config.INPUT_PATH + self.config.VIDEO_FILE)
         if not cap.isOpened(): 
-            raise Exception("from {} read video failed".format(args.INPUT_PATH + args.VIDEO_FILE))
+            raise Exception("from {} read video failed".format(self.config.INPUT_PATH + self.config.VIDEO_FILE))
         while True:
             key = cv2.waitKey(1)
-            ok, raw_frame = cap.read()
+            with metrics.stage('calibmode.read'):
+                ok, raw_frame = cap.read()
+            if not ok: break
             raw_frame = self.imgPreprocess(raw_frame)
             display = "raw_frame: press SPACE to capture image"
             cv2.namedWindow(display, flags = cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
             cv2.imshow(display, raw_frame)
             if key == 32:
-                if args.STORE_FLAG:
-                    cv2.imwrite(args.STORE_PATH + 'img_raw{}.jpg'.format(len(self.calibrator.corners)), raw_frame)
+                if self.config.STORE_FLAG:
+                    cv2.imwrite(self.config.STORE_PATH + 'img_raw{}.jpg'.format(len(self.calibrator.corners)), raw_frame)
                 result = self.runCalib(raw_frame) 
                 print(len(self.calibrator.corners))
             if key == 27: break
         cap.release()
-        cv2.destroyAllWindows() 
+        self.closeWindows() 
         return result
     
     def cameraAutoMode(self):
-        cap = cv2.VideoCapture(args.CAMERA_ID)
-        if not cap.isOpened(): 
-            raise Exception("from {} read video failed".format(args.CAMERA_ID))
-        cap = self.setCamera(cap)
+        cap = self.openCamera()
         frame_id = 0
-        start_flag = False
-        while True:
-            key = cv2.waitKey(1)
-            ok, raw_frame = cap.read()
-            raw_frame = self.imgPreprocess(raw_frame)
-            if key == 32: start_flag = True
-            if key == 27: break
-            if not start_flag:
-                cv2.putText(raw_frame, 'press SPACE to start!', (args.FRAME_WIDTH//4,args.FRAME_HEIGHT//2), 
-                             cv2.FONT_HERSHEY_COMPLEX, 1.5, (0,0,255), 2)
-                cv2.imshow("raw_frame", raw_frame)
-                continue
-            if frame_id % args.FRAME_DELAY == 0:
-                if args.STORE_FLAG:
-                    cv2.imwrite(args.STORE_PATH + 'img_raw{}.jpg'.format(len(self.calibrator.corners)), raw_frame)
-                result = self.runCalib(raw_frame) 
-                print(len(self.calibrator.corners))
-            frame_id += 1 
-        cap.release()
-        cv2.destroyAllWindows() 
+        # headless runs start at once and stop after MAX_FRAMES frames or on Ctrl+C
+        start_flag = self.config.HEADLESS_FLAG
+        result = self.calibrator.camera.data
+        try:
+            while self.config.MAX_FRAMES <= 0 or frame_id < self.config.MAX_FRAMES:
+                key = self.waitKey(1)
+                with metrics.stage('calibmode.read'):
+                    ok, raw_frame = cap.read()
+                if not ok:
+                    raise Exception("camera {} read failed".format(self.config.CAMERA_ID))
+                raw_frame = self.imgPreprocess(raw_frame)
+                if key == 32: start_flag = True
+                if key == 27: break
+                if not start_flag:
+                    cv2.putText(raw_frame, 'press SPACE to start!', (self.config.FRAME_WIDTH//4,self.config.FRAME_HEIGHT//2), 
+                                 cv2.FONT_HERSHEY_COMPLEX, 1.5, (0,0,255), 2)
+                    cv2.imshow("raw_frame", raw_frame)
+                    continue
+                if frame_id % self.config.FRAME_DELAY == 0:
+                    if self.config.STORE_FLAG:
+                        cv2.imwrite(self.config.STORE_PATH + 'img_raw{}.jpg'.format(len(self.calibrator.corners)), raw_frame)
+                    result = self.runCalib(raw_frame) 
+                    print(len(self.calibrator.corners))
+                frame_id += 1 
+        except KeyboardInterrupt:
+            pass
+        self.closeCamera(cap)
+        self.closeWindows() 
         return result
     
     def cameraManualMode(self):
-        cap = cv2.VideoCapture(args.CAMERA_ID)
-        if not cap.isOpened(): 
-            raise Exception("from {} read video failed".format(args.CAMERA_ID))
-        cap = self.setCamera(cap)
+        cap = self.openCamera()
         while True:
             key = cv2.waitKey(1)
-            ok, raw_frame = cap.read()
+            with metrics.stage('calibmode.read'):
+                ok, raw_frame = cap.read()
+            if not ok:
+                raise Exception("camera {} read failed".format(self.config.CAMERA_ID))
             raw_frame = self.imgPreprocess(raw_frame)
             display = "raw_frame: press SPACE to capture image"
             cv2.namedWindow(display, flags = cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
             cv2.imshow(display, raw_frame)
             if key == 32:
-                if args.STORE_FLAG:
-                    cv2.imwrite(args.STORE_PATH + 'img_raw{}.jpg'.format(len(self.calibrator.corners)), raw_frame)
+                if self.config.STORE_FLAG:
+                    cv2.imwrite(self.config.STORE_PATH + 'img_raw{}.jpg'.format(len(self.calibrator.corners)), raw_frame)
                 result = self.runCalib(raw_frame) 
                 print(len(self.calibrator.corners))
             if key == 27: break
-        cap.release()
-        cv2.destroyAllWindows() 
+        self.closeCamera(cap)
+        self.closeWindows() 
         return result
 
     def __call__(self):
         input_type = self.input_type
         mode = self.mode
+        if self.config.HEADLESS_FLAG and mode == 'manual':
+            raise Exception("manual mode needs a display, use auto or batch mode when headless")
         if input_type == 'image' and mode == 'auto':
             result = self.imageAutoMode()
         if input_type == 'image' and mode == 'manual':
             result = self.imageManualMode()
+        if input_type == 'image' and mode == 'batch':
+            result = self.imageBatchMode()
         if input_type == 'video' and mode == 'auto':
             result = self.videoAutoMode()
         if input_type == 'video' and mode == 'manual':
@@ -393,13 +903,22 @@ class CalibMode():
             result = self.cameraAutoMode()
         if input_type == 'camera' and mode == 'manual':
             result = self.cameraManualMode()
+        if mode != 'batch':
+            result = self.calibrator.finish()
         return result
 
 
-def main():
-    calibrator = InCalibrator(args.CAMERA_TYPE)
+def main(args=None):
+    args = args if args is not None else parse_args()
+    if args.METRICS_PATH is not None:
+        metrics.enable()
+    calibrator = InCalibrator(args.CAMERA_TYPE, args)
     calib = CalibMode(calibrator, args.INPUT_TYPE, args.SELECT_MODE)
     result = calib()
+    if args.RESULT_PATH is not None:
+        # written before the checks below, so failed runs leave a result too
+        with open(args.RESULT_PATH, 'w') as f:
+            json.dump(dict(result.to_dict(), camera_id=args.CAMERA_ID, camera_name=args.CAMERA_NAME), f, indent=2)
                   
     if len(calibrator.corners) == 0: 
         raise Exception("Calibration failed. Chessboard not found, check the parameters")  
@@ -410,8 +929,17 @@ def main():
     print("Camera Matrix is : {}".format(result.camera_mat.tolist())) 
     print("Distortion Coefficient is : {}".format(result.dist_coeff.tolist()))
     print("Reprojection Error is : {}".format(np.mean(result.reproj_err))) 
-    np.save('camera_{}_K.npy'.format(args.CAMERA_ID),result.camera_mat.tolist())
-    np.save('camera_{}_D.npy'.format(args.CAMERA_ID),result.dist_coeff.tolist())
+    for view, err in result.dropped:
+        print("Dropped view {} with reprojection error {}".format(view, err))
+    np.save('camera_{}_K.npy'.format(args.CAMERA_ID),result.camera_mat)
+    np.save('camera_{}_D.npy'.format(args.CAMERA_ID),result.dist_coeff)
+    if args.BUNDLE_PATH is not None:
+        # maps stored for the old K/D are dropped, surroundBEV -save_bundle rebuilds them
+        name = args.CAMERA_NAME if args.CAMERA_NAME is not None else str(args.CAMERA_ID)
+        update_bundle(args.BUNDLE_PATH, name, {'K': result.camera_mat, 'D': result.dist_coeff},
+                      {'image_size': list(result.image_size)}, drop=['bev1', 'bev2'])
+    if args.METRICS_PATH is not None:
+        metrics.write(args.METRICS_PATH)
         
 if __name__ == '__main__':
     main()
@@ -1,4 +1,4 @@
-from .surroundBEV import BevGenerator
+from .surroundBEV import BevGenerator, BevStream, BevBatch, BevConfig
 
 """
 Surround Camera Bird Eye View Generator
@@ -11,8 +11,34 @@ Instructions:
 or
     bev = BevGenerator(blend=True, balance=True)
     surround = bev(front,back,left,right,car)
+or for several output resolutions from one render
+    bev = BevGenerator(scales=[1, 0.5, 0.25])
+    full, half, quarter = bev(front,back,left,right,car)
+or from a single calibration bundle of the vehicle (see Tools/calibBundle.py)
+    bev = BevGenerator(bundle='./vehicle.calib')
+with WORKERS threads, close() (or a with block) stops them
+    with BevGenerator(workers=4) as bev:
+        surround = bev(front,back,left,right)
+or for recorded videos
+    from surroundBEV import BevGenerator, BevStream
+
+    stream = BevStream(BevGenerator(), path, output)
+    stats = stream()
+or for offline batches on several processes
+    from surroundBEV import BevGenerator, BevBatch
+
+    batch = BevBatch(BevGenerator(), processes)
+    for surround in batch(frame_sets):
+        ...
     
-You can edit parameters in the original file, or
+Parameters come from a BevConfig, importing parses no command line
+    from surroundBEV import BevGenerator, BevConfig
+
+    config = BevConfig(CAR_WIDTH=200, CAR_HEIGHT=350, DATA_PATH=path)
+    bev = BevGenerator(blend=True, config=config)  # keyword arguments override the config
+so several vehicles can be kept in one process
+    bevs = {name: BevGenerator(config=config) for name, config in configs.items()}
+or edit the default config used when none is given
     args = BevGenerator.get_args()
     args.CAR_WIDTH = 200
     args.CAR_HEIGHT = 350
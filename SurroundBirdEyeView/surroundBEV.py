@@ -1,29 +1,99 @@
 import cv2
 import numpy as np
 import argparse
+import hashlib
+import multiprocessing
 import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from multiprocessing import shared_memory
 
-parser = argparse.ArgumentParser(description="Generate Surrounding Camera Bird Eye View")
-parser.add_argument('-fw', '--FRAME_WIDTH', default=1280, type=int, help='Camera Frame Width')
-parser.add_argument('-fh', '--FRAME_HEIGHT', default=1024, type=int, help='Camera Frame Height')
-parser.add_argument('-bw', '--BEV_WIDTH', default=1000, type=int, help='BEV Frame Width')
-parser.add_argument('-bh', '--BEV_HEIGHT', default=1000, type=int, help='BEV Frame Height')
-parser.add_argument('-cw', '--CAR_WIDTH', default=250, type=int, help='Car Frame Width')
-parser.add_argument('-ch', '--CAR_HEIGHT', default=400, type=int, help='Car Frame Height')
-parser.add_argument('-fs', '--FOCAL_SCALE', default=1, type=float, help='Camera Undistort Focal Scale')
-parser.add_argument('-ss', '--SIZE_SCALE', default=2, type=float, help='Camera Undistort Size Scale')
-parser.add_argument('-blend','--BLEND_FLAG', default=False, type=bool, help='Blend BEV Image (Ture/False)')
-parser.add_argument('-balance','--BALANCE_FLAG', default=False, type=bool, help='Balance BEV Image (Ture/False)')
-args = parser.parse_args()
-
-FRAME_WIDTH = args.FRAME_WIDTH
-FRAME_HEIGHT = args.FRAME_HEIGHT
-BEV_WIDTH = args.BEV_WIDTH
-BEV_HEIGHT = args.BEV_HEIGHT
-CAR_WIDTH = args.CAR_WIDTH
-CAR_HEIGHT = args.CAR_HEIGHT
-FOCAL_SCALE = args.FOCAL_SCALE
-SIZE_SCALE = args.SIZE_SCALE
+if __package__ in (None, ''):
+    # run as a script from its own folder, the Tools package is in the repo root
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Tools.timeAlign import align_time
+from Tools.stageMetrics import metrics
+from Tools.calibBundle import CalibBundle, write_bundle
+
+@dataclass
+class BevConfig:
+    FRAME_WIDTH: int = 1280
+    FRAME_HEIGHT: int = 1024
+    BEV_WIDTH: int = 1000
+    BEV_HEIGHT: int = 1000
+    CAR_WIDTH: int = 250
+    CAR_HEIGHT: int = 400
+    FOCAL_SCALE: float = 1
+    SIZE_SCALE: float = 2
+    BLEND_FLAG: bool = False
+    BALANCE_FLAG: bool = False
+    BALANCE_MODE: str = 'global'
+    BALANCE_RATE: float = 0.2
+    BALANCE_INTERVAL: int = 5
+    FUSED_FLAG: bool = False
+    CACHE_PATH: str = None
+    CACHE_SIZE: int = 1024
+    WORKERS: int = 0
+    STREAM_PATH: str = None
+    OUTPUT_FILE: str = 'surround.mp4'
+    OUTPUT_FPS: int = 25
+    QUEUE_SIZE: int = 8
+    PROCESSES: int = 0
+    ALIGN_THRESH: float = 0.1
+    DATA_PATH: str = None
+    METRICS_PATH: str = None
+    SCALES: list = None
+    BUNDLE_PATH: str = None
+    SAVE_BUNDLE: str = None
+
+def get_parser():
+    # defaults come from BevConfig, parse_args fills the command line values into a config
+    parser = argparse.ArgumentParser(description="Generate Surround Camera Bird Eye View")
+    parser.add_argument('-fw', '--FRAME_WIDTH', type=int, help='Camera Frame Width')
+    parser.add_argument('-fh', '--FRAME_HEIGHT', type=int, help='Camera Frame Height')
+    parser.add_argument('-bw', '--BEV_WIDTH', type=int, help='BEV Frame Width')
+    parser.add_argument('-bh', '--BEV_HEIGHT', type=int, help='BEV Frame Height')
+    parser.add_argument('-cw', '--CAR_WIDTH', type=int, help='Car Frame Width')
+    parser.add_argument('-ch', '--CAR_HEIGHT', type=int, help='Car Frame Height')
+    parser.add_argument('-fs', '--FOCAL_SCALE', type=float, help='Camera Undistort Focal Scale')
+    parser.add_argument('-ss', '--SIZE_SCALE', type=float, help='Camera Undistort Size Scale')
+    parser.add_argument('-blend', '--BLEND_FLAG', type=bool, help='Blend BEV Image (Ture/False)')
+    parser.add_argument('-balance', '--BALANCE_FLAG', type=bool, help='Balance BEV Image (Ture/False)')
+    parser.add_argument('-balance_mode', '--BALANCE_MODE', type=str, choices=['global', 'overlap'], help='Balance Mode: global/overlap')
+    parser.add_argument('-balance_rate', '--BALANCE_RATE', type=float, help='Temporal Smoothing Rate of Balance Gains (0~1)')
+    parser.add_argument('-balance_interval', '--BALANCE_INTERVAL', type=int, help='Update Balance Gains Every N Frames')
+    parser.add_argument('-fused', '--FUSED_FLAG', type=bool, help='Use Fused Lookup Table for BEV (Ture/False)')
+    parser.add_argument('-cache', '--CACHE_PATH', type=str, help='Path to Cache BEV Maps and Blend Weights (None to disable)')
+    parser.add_argument('-cache_size', '--CACHE_SIZE', type=int, help='Max Size of Map Cache (MB)')
+    parser.add_argument('-workers', '--WORKERS', type=int, help='Worker Threads for Per-Camera Stage (0 for serial)')
+    parser.add_argument('-stream', '--STREAM_PATH', type=str, help='Path of front/back/left/right Videos or Image Folders (None for single images)')
+    parser.add_argument('-output', '--OUTPUT_FILE', type=str, help='Output BEV Video File')
+    parser.add_argument('-fps', '--OUTPUT_FPS', type=int, help='Output BEV Video Frame per Second')
+    parser.add_argument('-queue', '--QUEUE_SIZE', type=int, help='Max Frames Buffered between Stream Stages')
+    parser.add_argument('-processes', '--PROCESSES', type=int, help='Worker Processes for Stream Rendering (0 to render in thread)')
+    parser.add_argument('-align', '--ALIGN_THRESH', type=float, help='Time Align Threshold of Four Cameras (s)')
+    parser.add_argument('-data', '--DATA_PATH', type=str, help='Path of front/back/left/right Camera K/D/H Files (None for ./data/)')
+    parser.add_argument('-metrics', '--METRICS_PATH', type=str, help='Path to Write Stage Timing Metrics (.json or .prom, None to disable)')
+    parser.add_argument('-scales', '--SCALES', type=float, nargs='+', help='Output Scales of BEV Rendered in One Call (eg.: 1 0.5 0.25)')
+    parser.add_argument('-bundle', '--BUNDLE_PATH', type=str, help='Vehicle Calibration Bundle of K/D/H and Maps (None to read DATA_PATH)')
+    parser.add_argument('-save_bundle', '--SAVE_BUNDLE', type=str, help='Write K/D/H and BEV Maps to This Bundle File and Exit')
+    parser.set_defaults(**vars(BevConfig()))
+    return parser
+
+def parse_args(argv=None, config=None):
+    config = replace(config) if config is not None else BevConfig()
+    return get_parser().parse_args(argv, namespace=config)
+
+# used by every class created without a config, see BevGenerator.get_args
+default_config = BevConfig()
 
 def padding(img,width,height):
     H = img.shape[0]
@@ -54,73 +124,216 @@ def color_balance(image):
     cv2.addWeighted(r, Kr, 0, 0, 0, r)
     return cv2.merge([b,g,r])
 
-def luminance_balance(images):
-    [front,back,left,right] = [cv2.cvtColor(image,cv2.COLOR_BGR2HSV) 
-                               for image in images]
-    hf, sf, vf = cv2.split(front)
-    hb, sb, vb = cv2.split(back)
-    hl, sl, vl = cv2.split(left)
-    hr, sr, vr = cv2.split(right)
-    V_f = np.mean(vf)
-    V_b = np.mean(vb)
-    V_l = np.mean(vl)
-    V_r = np.mean(vr)
-    V_mean = (V_f + V_b + V_l +V_r) / 4
-    vf = cv2.add(vf,(V_mean - V_f))
-    vb = cv2.add(vb,(V_mean - V_b))
-    vl = cv2.add(vl,(V_mean - V_l))
-    vr = cv2.add(vr,(V_mean - V_r))
-    front = cv2.merge([hf,sf,vf])
-    back = cv2.merge([hb,sb,vb])
-    left = cv2.merge([hl,sl,vl])
-    right = cv2.merge([hr,sr,vr])
-    images = [front,back,left,right]
-    images = [cv2.cvtColor(image,cv2.COLOR_HSV2BGR) for image in images]
+def luminance_balance(images, dispatch=map):
+    def to_hsv(image):
+        h, s, v = cv2.split(cv2.cvtColor(image,cv2.COLOR_BGR2HSV))
+        return (h, s, v), np.mean(v)
+    def to_bgr(hsv, V):
+        h, s, v = hsv
+        v = cv2.add(v,(V_mean - V))
+        return cv2.cvtColor(cv2.merge([h,s,v]),cv2.COLOR_HSV2BGR)
+    hsv, V = zip(*dispatch(to_hsv, images))
+    V_mean = sum(V) / 4
+    images = list(dispatch(to_bgr, hsv, V))
     return images
 
+def fixed_weight(mask):
+    # 0~255 weights to 0~256 fixed point, so that (x * w) >> 8 keeps x unchanged at full weight
+    return ((mask.astype(np.uint32) * 256 + 127) // 255).astype(np.uint16)
+
+def fixed_blend(img, weight, out=None, tmp=None):
+    if img.ndim == 3 and weight.ndim == 2:
+        weight = weight[..., np.newaxis]
+    tmp = np.multiply(img, weight, out=tmp)
+    np.right_shift(tmp, 8, out=tmp)
+    if out is None:
+        return tmp.astype(np.uint8)
+    np.copyto(out, tmp, casting='unsafe')
+    return out
+
+class MapCache:
+    VERSION = 2
+
+    def __init__(self, path, size=BevConfig.CACHE_SIZE):
+        self.path = path
+        self.size = size * 1024 * 1024
+        os.makedirs(self.path, exist_ok=True)
+
+    def get_key(self, *items):
+        sha = hashlib.sha1(str(self.VERSION).encode())
+        for item in items:
+            if isinstance(item, np.ndarray):
+                item = np.ascontiguousarray(item)
+                sha.update(str((item.dtype.str, item.shape)).encode())
+                sha.update(item.tobytes())
+            else:
+                sha.update(repr(item).encode())
+        return sha.hexdigest()
+
+    def load(self, key, names):
+        entry = os.path.join(self.path, key)
+        try:
+            arrays = [np.load(os.path.join(entry, name + '.npy'), mmap_mode='r') for name in names]
+        except (OSError, ValueError):
+            return None
+        os.utime(entry)
+        return arrays
+
+    def save(self, key, names, arrays):
+        entry = os.path.join(self.path, key)
+        tmp = '{}.tmp{}'.format(entry, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for name, array in zip(names, arrays):
+            np.save(os.path.join(tmp, name + '.npy'), array)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.path):
+            entry = os.path.join(self.path, key)
+            if '.tmp' in key or not os.path.isdir(entry):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+def get_map_geometry(config):
+    # everything besides K/D/H the BEV maps depend on
+    return {key: getattr(config, key) for key in
+            ['FRAME_WIDTH', 'FRAME_HEIGHT', 'BEV_WIDTH', 'BEV_HEIGHT', 'FOCAL_SCALE', 'SIZE_SCALE']}
+
 class Camera:
-    def __init__(self, name):
-        self.camera_mat = np.load(os.path.dirname(__file__) + '/data/{}/camera_{}_K.npy'.format(name,name))
-        self.dist_coeff = np.load(os.path.dirname(__file__) + '/data/{}/camera_{}_D.npy'.format(name,name))
-        self.homography = np.load(os.path.dirname(__file__) + '/data/{}/camera_{}_H.npy'.format(name,name))
+    def __init__(self, name, config=None, cache=None, bundle=None):
+        self.config = config if config is not None else default_config
+        if bundle is not None:
+            self.load_bundle(name, bundle)
+        else:
+            path = self.config.DATA_PATH if self.config.DATA_PATH is not None else os.path.dirname(__file__) + '/data/'
+            self.camera_mat = np.load(os.path.join(path, '{}/camera_{}_K.npy'.format(name,name)))
+            self.dist_coeff = np.load(os.path.join(path, '{}/camera_{}_D.npy'.format(name,name)))
+            self.homography = np.load(os.path.join(path, '{}/camera_{}_H.npy'.format(name,name)))
         self.camera_mat_dst = self.get_camera_mat_dst()
-        self.undistort_maps = self.get_undistort_maps()
-        self.bev_maps = self.get_bev_maps()
+        self.undistort_maps = None
+        maps = None
+        if bundle is not None and bundle.has(name, 'bev1') and bundle.meta.get('maps') == get_map_geometry(self.config):
+            # memory-mapped straight from the bundle, pages are read when remap touches them
+            maps = [bundle.get(name, 'bev1'), bundle.get(name, 'bev2')]
+            metrics.count('camera.bundle_maps')
+        elif cache is not None:
+            c = self.config
+            key = cache.get_key('camera', self.camera_mat, self.dist_coeff, self.homography, c.FRAME_WIDTH,
+                                c.FRAME_HEIGHT, c.BEV_WIDTH, c.BEV_HEIGHT, c.FOCAL_SCALE, c.SIZE_SCALE)
+            maps = cache.load(key, ['bev1', 'bev2'])
+            metrics.count('camera.cache_miss' if maps is None else 'camera.cache_hit')
+        if maps is None:
+            with metrics.stage('camera.bev_maps'):
+                self.bev_maps = self.get_bev_maps()
+            if cache is not None:
+                cache.save(key, ['bev1', 'bev2'], self.bev_maps)
+        else:
+            self.bev_maps = (maps[0], maps[1])
+
+    def load_bundle(self, name, bundle):
+        for key in ['K', 'D', 'H']:
+            if not bundle.has(name, key):
+                raise Exception("bundle {} has no {} of camera {}".format(bundle.path, key, name))
+        size = bundle.info(name).get('image_size')
+        if size is not None and tuple(size) != (self.config.FRAME_WIDTH, self.config.FRAME_HEIGHT):
+            raise Exception("camera {} of bundle {} is calibrated at {}x{}, not {}x{}".format(
+                            name, bundle.path, size[0], size[1], self.config.FRAME_WIDTH, self.config.FRAME_HEIGHT))
+        self.camera_mat = np.array(bundle.get(name, 'K'))
+        self.dist_coeff = np.array(bundle.get(name, 'D'))
+        self.homography = np.array(bundle.get(name, 'H'))
         
     def get_camera_mat_dst(self):
+        c = self.config
         camera_mat_dst = self.camera_mat.copy()
-        camera_mat_dst[0][0] *= FOCAL_SCALE
-        camera_mat_dst[1][1] *= FOCAL_SCALE
-        camera_mat_dst[0][2] = FRAME_WIDTH / 2 * SIZE_SCALE
-        camera_mat_dst[1][2] = FRAME_HEIGHT / 2 * SIZE_SCALE
+        camera_mat_dst[0][0] *= c.FOCAL_SCALE
+        camera_mat_dst[1][1] *= c.FOCAL_SCALE
+        camera_mat_dst[0][2] = c.FRAME_WIDTH / 2 * c.SIZE_SCALE
+        camera_mat_dst[1][2] = c.FRAME_HEIGHT / 2 * c.SIZE_SCALE
         return camera_mat_dst
     
     def get_undistort_maps(self):
+        c = self.config
         undistort_maps = cv2.fisheye.initUndistortRectifyMap(
                     self.camera_mat, self.dist_coeff, 
                     np.eye(3, 3), self.camera_mat_dst,
-                    (int(FRAME_WIDTH * SIZE_SCALE), int(FRAME_HEIGHT * SIZE_SCALE)), cv2.CV_16SC2)
+                    (int(c.FRAME_WIDTH * c.SIZE_SCALE), int(c.FRAME_HEIGHT * c.SIZE_SCALE)), cv2.CV_16SC2)
         return undistort_maps
     
-    def get_bev_maps(self):
-        map1 = self.warp_homography(self.undistort_maps[0])
-        map2 = self.warp_homography(self.undistort_maps[1])
-        return (map1, map2)
+    def get_bev_maps(self, scale=1):
+        # BEV pixel -> undistorted pixel (inverse homography) -> raw pixel (fisheye model),
+        # the same mapping as warping the undistort maps, without building them
+        c = self.config
+        u, v = np.meshgrid(np.arange(round(c.BEV_WIDTH * scale), dtype=np.float64),
+                           np.arange(round(c.BEV_HEIGHT * scale), dtype=np.float64))
+        if scale != 1:
+            # pixel centers of the scaled BEV in full resolution BEV coordinates
+            u = (u + 0.5) / scale - 0.5
+            v = (v + 0.5) / scale - 0.5
+        H_inv = np.linalg.inv(self.homography)
+        X = H_inv[0, 0] * u + H_inv[0, 1] * v + H_inv[0, 2]
+        Y = H_inv[1, 0] * u + H_inv[1, 1] * v + H_inv[1, 2]
+        Z = H_inv[2, 0] * u + H_inv[2, 1] * v + H_inv[2, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_dst = X / Z
+            y_dst = Y / Z
+        valid = (Z != 0) & (x_dst >= 0) & (x_dst < int(c.FRAME_WIDTH * c.SIZE_SCALE)) \
+                        & (y_dst >= 0) & (y_dst < int(c.FRAME_HEIGHT * c.SIZE_SCALE))
+        K = self.camera_mat_dst
+        y = np.where(valid, (y_dst - K[1, 2]) / K[1, 1], 0)
+        x = np.where(valid, (x_dst - K[0, 2] - K[0, 1] * y) / K[0, 0], 0)
+        r = np.sqrt(x**2 + y**2)
+        theta = np.arctan(r)
+        k1, k2, k3, k4 = self.dist_coeff.ravel()[:4]
+        theta_d = theta * (1 + k1 * theta**2 + k2 * theta**4 + k3 * theta**6 + k4 * theta**8)
+        scale = np.where(r > 1e-8, theta_d / np.maximum(r, 1e-8), 1.0)
+        x *= scale
+        y *= scale
+        K = self.camera_mat
+        map_x = np.where(valid, K[0, 0] * x + K[0, 1] * y + K[0, 2], -1).astype(np.float32)
+        map_y = np.where(valid, K[1, 1] * y + K[1, 2], -1).astype(np.float32)
+        return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
     
     def undistort(self, img):
-        return cv2.remap(img, *self.undistort_maps, interpolation = cv2.INTER_LINEAR)
+        if self.undistort_maps is None:
+            with metrics.stage('camera.undistort_maps'):
+                self.undistort_maps = self.get_undistort_maps()
+        with metrics.stage('camera.undistort'):
+            return cv2.remap(img, *self.undistort_maps, interpolation = cv2.INTER_LINEAR)
         
     def warp_homography(self, img):
-        return cv2.warpPerspective(img, self.homography, (BEV_WIDTH,BEV_HEIGHT))
+        return cv2.warpPerspective(img, self.homography, (self.config.BEV_WIDTH,self.config.BEV_HEIGHT))
         
-    def raw2bev(self, img):
-        return cv2.remap(img, *self.bev_maps, interpolation = cv2.INTER_LINEAR)
+    def raw2bev(self, img, dst=None):
+        return cv2.remap(img, *self.bev_maps, interpolation = cv2.INTER_LINEAR, dst=dst)
+
+    def crop(self, rect):
+        # keep only the maps inside rect, raw2bev then returns that ROI of the BEV
+        x, y, w, h = rect
+        self.rect = rect
+        self.bev_maps = tuple(np.ascontiguousarray(m[y:y+h, x:x+w]) for m in self.bev_maps)
 
 class Mask:
-    def __init__(self, name):
+    def __init__(self, name, config=None):
+        self.config = config if config is not None else default_config
         self.mask = self.get_mask(name)
+        self.area = self.mask
+        self.rect = cv2.boundingRect(self.mask)
         
     def get_points(self, name):
+        BEV_WIDTH, BEV_HEIGHT = self.config.BEV_WIDTH, self.config.BEV_HEIGHT
+        CAR_WIDTH, CAR_HEIGHT = self.config.CAR_WIDTH, self.config.CAR_HEIGHT
         if name == 'front':
             points = np.array([
                 [0, 0],
@@ -154,40 +367,41 @@ class Mask:
         return points
     
     def get_mask(self, name):
-        mask = np.zeros((BEV_HEIGHT,BEV_WIDTH), dtype=np.uint8)
+        mask = np.zeros((self.config.BEV_HEIGHT,self.config.BEV_WIDTH), dtype=np.uint8)
         points = self.get_points(name)
         return cv2.fillPoly(mask, [points], 255)
     
+    def crop(self):
+        x, y, w, h = self.rect
+        self.mask = self.mask[y:y+h, x:x+w].copy()
+        self.area = self.mask
+
+    def apply(self, img):
+        # weights are all 255 inside area, nothing to do in place
+        return img
+
     def __call__(self, img):
         return cv2.bitwise_and(img, img, mask=self.mask)
 
 class BlendMask:
-    def __init__(self,name):
-        mf = self.get_mask('front')
-        mb = self.get_mask('back')
-        ml = self.get_mask('left')
-        mr = self.get_mask('right')
-        self.get_lines()
-        if name == 'front':
-            mf = self.get_blend_mask(mf, ml, self.lineFL, self.lineLF)
-            mf = self.get_blend_mask(mf, mr, self.lineFR, self.lineRF)
-            self.mask = mf
-        if name == 'back':
-            mb = self.get_blend_mask(mb, ml, self.lineBL, self.lineLB)
-            mb = self.get_blend_mask(mb, mr, self.lineBR, self.lineRB)
-            self.mask = mb
-        if name == 'left':
-            ml = self.get_blend_mask(ml, mf, self.lineLF, self.lineFL)
-            ml = self.get_blend_mask(ml, mb, self.lineLB, self.lineBL)
-            self.mask = ml
-        if name == 'right':
-            mr = self.get_blend_mask(mr, mf, self.lineRF, self.lineFR)
-            mr = self.get_blend_mask(mr, mb, self.lineRB, self.lineBR)
-            self.mask = mr
-        self.weight = np.repeat(self.mask[:, :, np.newaxis], 3, axis=2) / 255.0
-        self.weight = self.weight.astype(np.float32)
+    cache = {}
+
+    def __init__(self, name, config=None, cache=None):
+        self.config = config if config is not None else default_config
+        masks, regions = self.get_blend_masks(cache)
+        if name not in masks:
+            raise Exception("name should be front/back/left/right")
+        self.mask = masks[name]
+        self.regions = regions[name]
+        self.rect = cv2.boundingRect(self.get_mask(name))
+        self.solid = np.where(self.mask == 255, 255, 0).astype(np.uint8)
+        self.area = np.where(self.mask > 0, 255, 0).astype(np.uint8)
+        self.weights = [fixed_weight(self.mask[y:y+h, x:x+w]) for x, y, w, h in self.regions]
+        self.tmp = [None] * len(self.regions)
         
     def get_points(self, name):
+        BEV_WIDTH, BEV_HEIGHT = self.config.BEV_WIDTH, self.config.BEV_HEIGHT
+        CAR_WIDTH, CAR_HEIGHT = self.config.CAR_WIDTH, self.config.CAR_HEIGHT
         if name == 'front':
             points = np.array([
                 [0, 0],
@@ -229,11 +443,13 @@ class BlendMask:
         return points
     
     def get_mask(self, name):
-        mask = np.zeros((BEV_HEIGHT,BEV_WIDTH), dtype=np.uint8)
+        mask = np.zeros((self.config.BEV_HEIGHT,self.config.BEV_WIDTH), dtype=np.uint8)
         points = self.get_points(name)
         return cv2.fillPoly(mask, [points], 255)
     
     def get_lines(self):
+        BEV_WIDTH, BEV_HEIGHT = self.config.BEV_WIDTH, self.config.BEV_HEIGHT
+        CAR_WIDTH, CAR_HEIGHT = self.config.CAR_WIDTH, self.config.CAR_HEIGHT
         self.lineFL = np.array([
                         [0, BEV_HEIGHT/5], 
                         [(BEV_WIDTH-CAR_WIDTH)/2, (BEV_HEIGHT-CAR_HEIGHT)/2],
@@ -267,77 +483,913 @@ class BlendMask:
                         [(BEV_WIDTH+CAR_WIDTH)/2, (BEV_HEIGHT+CAR_HEIGHT)/2]
                     ]).astype(np.int32)
         
+    def get_blend_masks(self, cache=None):
+        # the four blend masks only depend on the BEV geometry, so they are built
+        # together once and shared by every BlendMask with the same geometry
+        names = ['front', 'back', 'left', 'right']
+        c = self.config
+        key = (c.BEV_WIDTH, c.BEV_HEIGHT, c.CAR_WIDTH, c.CAR_HEIGHT)
+        if key not in BlendMask.cache and cache is not None:
+            arrays = cache.load(cache.get_key('blend', *key), names + ['regions'])
+            metrics.count('blend.cache_miss' if arrays is None else 'blend.cache_hit')
+            if arrays is not None:
+                regions = {name: [tuple(int(v) for v in r) for r in arrays[-1][i]]
+                           for i, name in enumerate(names)}
+                BlendMask.cache[key] = (dict(zip(names, arrays[:-1])), regions)
+        if key not in BlendMask.cache:
+            with metrics.stage('blend.masks'):
+                masks, regions = self.build_blend_masks(names)
+            BlendMask.cache[key] = (masks, regions)
+            if cache is not None:
+                cache.save(cache.get_key('blend', *key), names + ['regions'],
+                           [masks[name] for name in names] + [np.array([regions[name] for name in names], dtype=np.int32)])
+        return BlendMask.cache[key]
+
+    def build_blend_masks(self, names):
+        m = {name: self.get_mask(name) for name in names}
+        self.get_lines()
+        pairs = {
+            'front': [('left', self.lineFL, self.lineLF), ('right', self.lineFR, self.lineRF)],
+            'back': [('left', self.lineBL, self.lineLB), ('right', self.lineBR, self.lineRB)],
+            'left': [('front', self.lineLF, self.lineFL), ('back', self.lineLB, self.lineBL)],
+            'right': [('front', self.lineRF, self.lineFR), ('back', self.lineRB, self.lineBR)],
+        }
+        masks, regions = {}, {}
+        for name, others in pairs.items():
+            self.regions = []
+            mask = m[name].copy()
+            for other, lineA, lineB in others:
+                mask = self.get_blend_mask(mask, m[other], lineA, lineB)
+            masks[name] = mask
+            regions[name] = self.regions
+        return masks, regions
+
+    def get_dist(self, points, line):
+        start, end = line.astype(np.float64)
+        seg = end - start
+        t = np.clip((points - start) @ seg / (seg @ seg), 0, 1)
+        return np.linalg.norm(points - start - t[:, np.newaxis] * seg, axis=1)
+
     def get_blend_mask(self, maskA, maskB, lineA, lineB):
         overlap = cv2.bitwise_and(maskA, maskB)
-        indices = np.where(overlap != 0)
-        for y, x in zip(*indices):
-            distA = cv2.pointPolygonTest(np.array(lineA), (x, y), True)
-            distB = cv2.pointPolygonTest(np.array(lineB), (x, y), True)
-            maskA[y, x] = distA**2 / (distA**2 + distB**2 + 1e-6) * 255
+        self.regions.append(cv2.boundingRect(overlap))
+        ys, xs = np.nonzero(overlap)
+        points = np.stack([xs, ys], axis=1).astype(np.float64)
+        distA = self.get_dist(points, lineA)
+        distB = self.get_dist(points, lineB)
+        maskA[ys, xs] = distA**2 / (distA**2 + distB**2 + 1e-6) * 255
         return maskA
     
+    def crop(self):
+        x, y, w, h = self.rect
+        self.mask = self.mask[y:y+h, x:x+w].copy()
+        self.solid = self.solid[y:y+h, x:x+w].copy()
+        self.area = self.area[y:y+h, x:x+w].copy()
+        self.regions = [(rx - x, ry - y, rw, rh) for rx, ry, rw, rh in self.regions]
+
+    def apply(self, img):
+        # weight the overlap regions in place, pixels outside area are left for the caller
+        for k, ((x, y, w, h), weight) in enumerate(zip(self.regions, self.weights)):
+            roi = img[y:y+h, x:x+w]
+            if self.tmp[k] is None or self.tmp[k].shape != roi.shape:
+                self.tmp[k] = np.empty(roi.shape, dtype=np.uint16)
+            fixed_blend(roi, weight, out=roi, tmp=self.tmp[k])
+        return img
+
     def __call__(self, img):
-        return (img * self.weight).astype(np.uint8)    
+        out = cv2.bitwise_and(img, img, mask=self.solid)
+        for (x, y, w, h), weight in zip(self.regions, self.weights):
+            out[y:y+h, x:x+w] = fixed_blend(img[y:y+h, x:x+w], weight)
+        return out
     
+class FusedLUT:
+    def __init__(self, maps, weights, frame_size, car_rect=None):
+        # the four frames are stacked vertically with one black row between them,
+        # so a single remap over the stack reads from the right camera
+        self.frame_width, self.frame_height = frame_size
+        self.stride = self.frame_height + 1
+        weights = np.stack(weights)
+        self.height, self.width = weights.shape[1:]
+        order = np.argsort(weights, axis=0, kind='stable')
+        first = order[-1]
+        second = order[-2]
+        self.map1, self.map2, valid1 = self.get_maps(maps, first)
+        map1_s, map2_s, valid2 = self.get_maps(maps, second)
+        w1 = np.take_along_axis(weights, first[np.newaxis], axis=0)[0]
+        w2 = np.take_along_axis(weights, second[np.newaxis], axis=0)[0]
+        w1 = np.where(valid1, w1, 0).astype(np.uint8)
+        w2 = np.where(valid2, w2, 0).astype(np.uint8)
+        invalid = (w1 == 0)
+        self.map1[invalid] = -2
+        self.map2[invalid] = 0
+        partial = ((w1 > 0) & (w1 < 255)) | (w2 > 0)
+        self.index = np.nonzero(partial)
+        self.count = len(self.index[0])
+        self.flat_index = np.ravel_multi_index(self.index, partial.shape)
+        self.map1_s = self.get_block(map1_s[self.index], -2)
+        self.map2_s = self.get_block(map2_s[self.index], 0)
+        self.weight1 = fixed_weight(w1[self.index])[:, np.newaxis]
+        self.weight2 = fixed_weight(w2[self.index])[:, np.newaxis]
+        self.stack = None
+        self.buffers = {}
+        self.car_rect = car_rect
+        self.full = [((slice(0, self.height), slice(0, self.width)), self.map1, self.map2)]
+        self.bands = self.get_bands(car_rect) if car_rect is not None else self.full
+
+    def get_bands(self, car_rect):
+        # bands around the car footprint, remapped instead of the full maps when a car covers it
+        x, y, w, h = car_rect
+        bands = [(slice(0, y), slice(0, self.width)),
+                 (slice(y, y + h), slice(0, x)),
+                 (slice(y, y + h), slice(x + w, self.width)),
+                 (slice(y + h, self.height), slice(0, self.width))]
+        return [(band, np.ascontiguousarray(self.map1[band]), np.ascontiguousarray(self.map2[band]))
+                for band in bands if self.map2[band].size > 0]
+
+    def get_buffer(self, name, shape, dtype):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self.buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def get_block(self, values, fill):
+        # remap needs rows < SHRT_MAX, so the overlap pixels are laid out as a 2D block
+        rows = -(-len(values) // self.width)
+        block = np.full((rows * self.width,) + values.shape[1:], fill, dtype=values.dtype)
+        block[:len(values)] = values
+        return block.reshape((rows, self.width) + values.shape[1:])
+
+    def get_maps(self, maps, select):
+        map1 = np.zeros(select.shape + (2,), dtype=np.int32)
+        map2 = np.zeros(select.shape, dtype=np.uint16)
+        for i, (bev_map1, bev_map2) in enumerate(maps):
+            region = (select == i)
+            map1[region] = bev_map1[region]
+            map1[region, 1] += i * self.stride
+            map2[region] = bev_map2[region]
+        y = map1[..., 1] - select * self.stride
+        valid = (y >= -1) & (y < self.frame_height)
+        map1[~valid] = -2
+        map2[~valid] = 0
+        return map1.astype(np.int16), map2, valid
+
+    def get_stack(self, images, luts=None):
+        shape = (self.stride * len(images),) + images[0].shape[1:]
+        if self.stack is None or self.stack.shape != shape or self.stack.dtype != images[0].dtype:
+            self.stack = np.zeros(shape, dtype=images[0].dtype)
+        for i, img in enumerate(images):
+            if img.shape[:2] != (self.frame_height, self.frame_width):
+                raise Exception("fused mode requires {}x{} frames".format(self.frame_width, self.frame_height))
+            tile = self.stack[i * self.stride : i * self.stride + self.frame_height]
+            if luts is None:
+                tile[...] = img
+            else:
+                cv2.LUT(img, luts[i], dst=tile)
+        return self.stack
+
+    def __call__(self, images, luts=None, out=None):
+        return self.render(self.get_stack(images, luts), out)
+
+    def render(self, stack, out=None, covered=False):
+        # stack may come from another FusedLUT, the stack layout only depends on the frame size
+        # covered: an opaque car is drawn over car_rect afterwards, so the footprint is left unwritten
+        surround = out
+        if surround is None:
+            surround = np.empty((self.height, self.width) + stack.shape[2:], dtype=stack.dtype)
+        with metrics.stage('fused.remap'):
+            for band, map1, map2 in (self.bands if covered else self.full):
+                cv2.remap(stack, map1, map2, interpolation = cv2.INTER_LINEAR, dst=surround[band])
+        if self.count > 0:
+            self.blend_overlap(stack, surround)
+        return surround
+
+    def blend_overlap(self, stack, surround):
+        with metrics.stage('fused.overlap'):
+            channels = stack.shape[2] if stack.ndim == 3 else 1
+            flat = surround.reshape(-1, channels)
+            first = self.get_buffer('first', (self.count, channels), stack.dtype)
+            tmp = self.get_buffer('tmp', (self.count, channels), np.uint16)
+            second = self.get_buffer('second', self.map2_s.shape + stack.shape[2:], stack.dtype)
+            np.take(flat, self.flat_index, axis=0, out=first, mode='clip')
+            cv2.remap(stack, self.map1_s, self.map2_s, interpolation = cv2.INTER_LINEAR, dst=second)
+            second = second.reshape(-1, channels)[:self.count]
+            fixed_blend(first, self.weight1, out=first, tmp=tmp)
+            fixed_blend(second, self.weight2, out=second, tmp=tmp)
+            cv2.add(first, second, dst=first)
+            flat[self.flat_index] = first
+
+class OverlapBalance:
+    def __init__(self, cameras, config=None, step=8, rate=None, interval=None):
+        self.config = config if config is not None else default_config
+        self.rate = rate if rate is not None else self.config.BALANCE_RATE
+        self.interval = interval if interval is not None else self.config.BALANCE_INTERVAL
+        # front-left, front-right, back-left, back-right
+        self.pairs = [(0, 2), (0, 3), (1, 2), (1, 3)]
+        self.samples = []
+        for name, (i, j) in zip(['FL', 'FR', 'BL', 'BR'], self.pairs):
+            mask = np.zeros((self.config.BEV_HEIGHT,self.config.BEV_WIDTH), dtype=np.uint8)
+            mask = cv2.fillPoly(mask, [self.get_points(name)], 255)
+            ys, xs = np.nonzero(mask[::step, ::step])
+            ys, xs = ys * step, xs * step
+            valid = self.get_valid(cameras[i], ys, xs) & self.get_valid(cameras[j], ys, xs)
+            ys, xs = ys[valid], xs[valid]
+            self.samples.append([(camera.bev_maps[0][ys, xs].reshape(-1, 1, 2),
+                                  camera.bev_maps[1][ys, xs].reshape(-1, 1))
+                                 for camera in (cameras[i], cameras[j])])
+        self.frame = 0
+        self.gains = None
+        self.luts = None
+
+    def get_points(self, name):
+        BEV_WIDTH, BEV_HEIGHT = self.config.BEV_WIDTH, self.config.BEV_HEIGHT
+        CAR_WIDTH, CAR_HEIGHT = self.config.CAR_WIDTH, self.config.CAR_HEIGHT
+        if name == 'FL':
+            points = np.array([
+                [0, 0],
+                [BEV_WIDTH/5, 0],
+                [(BEV_WIDTH-CAR_WIDTH)/2, (BEV_HEIGHT-CAR_HEIGHT)/2],
+                [0, BEV_HEIGHT/5]
+            ]).astype(np.int32)
+        elif name == 'FR':
+            points = np.array([
+                [BEV_WIDTH, 0],
+                [BEV_WIDTH - BEV_WIDTH/5, 0],
+                [(BEV_WIDTH+CAR_WIDTH)/2, (BEV_HEIGHT-CAR_HEIGHT)/2],
+                [BEV_WIDTH, BEV_HEIGHT/5]
+            ]).astype(np.int32)
+        elif name == 'BL':
+            points = np.array([
+                [0, BEV_HEIGHT],
+                [BEV_WIDTH/5, BEV_HEIGHT],
+                [(BEV_WIDTH-CAR_WIDTH)/2, (BEV_HEIGHT+CAR_HEIGHT)/2],
+                [0, BEV_HEIGHT - BEV_HEIGHT/5]
+            ]).astype(np.int32)
+        elif name == 'BR':
+            points = np.array([
+                [BEV_WIDTH, BEV_HEIGHT],
+                [BEV_WIDTH - BEV_WIDTH/5, BEV_HEIGHT],
+                [(BEV_WIDTH+CAR_WIDTH)/2, (BEV_HEIGHT+CAR_HEIGHT)/2],
+                [BEV_WIDTH, BEV_HEIGHT - BEV_HEIGHT/5]
+            ]).astype(np.int32)
+        else:
+            raise Exception("name should be FL/FR/BL/BR")
+        return points
+
+    def get_valid(self, camera, ys, xs):
+        x = camera.bev_maps[0][ys, xs, 0]
+        y = camera.bev_maps[0][ys, xs, 1]
+        return (x >= 0) & (x < self.config.FRAME_WIDTH - 1) & (y >= 0) & (y < self.config.FRAME_HEIGHT - 1)
+
+    def get_gains(self, images):
+        # least squares on log gains so that both cameras agree in every overlap,
+        # with the mean log gain fixed to 0, then gray world across the channels
+        means = []
+        for (i, j), samples in zip(self.pairs, self.samples):
+            values = [cv2.remap(img, *maps, interpolation = cv2.INTER_LINEAR).reshape(len(maps[1]), -1)
+                      for img, maps in zip((images[i], images[j]), samples)]
+            means.append([np.mean(v, axis=0) + 1 for v in values])
+        A = np.zeros((len(self.pairs) + 1, 4))
+        b = np.zeros((len(self.pairs) + 1, len(means[0][0])))
+        for k, ((i, j), (mean_i, mean_j)) in enumerate(zip(self.pairs, means)):
+            A[k, i] = 1
+            A[k, j] = -1
+            b[k] = np.log(mean_j) - np.log(mean_i)
+        A[-1] = 1
+        gains = np.exp(np.linalg.lstsq(A, b, rcond=None)[0])
+        balanced = np.mean([gains[i] * mean_i + gains[j] * mean_j
+                            for (i, j), (mean_i, mean_j) in zip(self.pairs, means)], axis=0)
+        gains *= np.mean(balanced) / balanced
+        return np.clip(gains, 0.5, 2)
+
+    def get_lut(self, gain):
+        lut = np.clip(np.arange(256)[:, np.newaxis] * gain, 0, 255).astype(np.uint8)
+        return lut if len(gain) == 1 else lut.reshape(256, 1, len(gain))
+
+    def __call__(self, images):
+        if self.frame % self.interval == 0:
+            with metrics.stage('balance.gains'):
+                gains = self.get_gains(images)
+            if self.gains is None:
+                self.gains = gains
+            else:
+                self.gains = (1 - self.rate) * self.gains + self.rate * gains
+            self.luts = [self.get_lut(gain) for gain in self.gains]
+        self.frame += 1
+        return self.luts
+
 class BevGenerator:
-    def __init__(self, blend=args.BLEND_FLAG, balance=args.BALANCE_FLAG):
-        self.init_args()
-        self.cameras = [Camera('front'), Camera('back'), 
-                        Camera('left'), Camera('right')]
-        self.blend = blend
-        self.balance = balance
+    def __init__(self, blend=None, balance=None, fused=None, cache=None, workers=None,
+                 balance_mode=None, scales=None, data_path=None, bundle=None, config=None):
+        # keyword arguments override the config, which is copied so later changes do not leak in
+        start = time.perf_counter()
+        config = config if config is not None else default_config
+        overrides = {'BLEND_FLAG': blend, 'BALANCE_FLAG': balance, 'FUSED_FLAG': fused, 'CACHE_PATH': cache,
+                     'WORKERS': workers, 'BALANCE_MODE': balance_mode, 'SCALES': scales, 'DATA_PATH': data_path,
+                     'BUNDLE_PATH': bundle}
+        self.config = config = replace(config, **{k: v for k, v in overrides.items() if v is not None})
+        self.executor = ThreadPoolExecutor(config.WORKERS) if config.WORKERS > 0 else None
+        # the threads of a generator dropped without close() are stopped once it is collected
+        self.finalizer = weakref.finalize(self, self.executor.shutdown, wait=False) if self.executor is not None else None
+        self.cache = MapCache(config.CACHE_PATH, config.CACHE_SIZE) if config.CACHE_PATH is not None else None
+        self.bundle = CalibBundle(config.BUNDLE_PATH) if config.BUNDLE_PATH is not None else None
+        self.cameras = [Camera(name, config, self.cache, self.bundle) for name in ['front', 'back', 'left', 'right']]
+        self.stages = [('bev.remap.' + name, 'bev.lut.' + name, 'bev.mask.' + name)
+                       for name in ['front', 'back', 'left', 'right']]
+        self.blend = config.BLEND_FLAG
+        self.balance = config.BALANCE_FLAG
+        self.balancer = None
+        if config.BALANCE_MODE not in ['global', 'overlap']:
+            raise Exception("balance mode should be global/overlap")
+        if self.balance and config.BALANCE_MODE == 'overlap':
+            self.balancer = OverlapBalance(self.cameras, config)
         if not self.blend:
-            self.masks = [Mask('front'), Mask('back'), 
-                          Mask('left'), Mask('right')]
+            self.masks = [Mask('front', config), Mask('back', config), 
+                          Mask('left', config), Mask('right', config)]
         else:
-            self.masks = [BlendMask('front'), BlendMask('back'), 
-                      BlendMask('left'), BlendMask('right')]
+            self.masks = [BlendMask('front', config, self.cache), BlendMask('back', config, self.cache), 
+                      BlendMask('left', config, self.cache), BlendMask('right', config, self.cache)]
+        self.fused = config.FUSED_FLAG
+        self.frame_size = (config.FRAME_WIDTH, config.FRAME_HEIGHT)
+        self.buffers = [None] * 4
+        self.car_rect = self.get_car_rect()
+        self.car = None
+        self.cars = {}
+        self.car_alpha = None
+        self.car_alphas = {}
+        self.scales = config.SCALES
+        self.levels = {}
+        for scale in self.scales or []:
+            if scale <= 0:
+                raise Exception("output scales should be positive")
+            if scale != 1 and scale not in self.levels:
+                self.levels[scale] = self.get_level(scale)
+        if self.fused:
+            with metrics.stage('bev.fused_lut'):
+                self.lut = FusedLUT([camera.bev_maps for camera in self.cameras],
+                                    [mask.mask for mask in self.masks], self.frame_size, self.car_rect)
+        else:
+            for camera, mask in zip(self.cameras, self.masks):
+                camera.crop(mask.rect)
+                mask.crop()
+        metrics.add('bev.init', time.perf_counter() - start)
+
+    def close(self):
+        # stops the WORKERS threads, later calls render the cameras serially
+        if self.executor is not None:
+            self.finalizer.detach()
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
 
     @staticmethod
     def get_args():
-        return args
-
-    def init_args(self):
-        global FRAME_WIDTH, FRAME_HEIGHT, BEV_WIDTH, BEV_HEIGHT
-        global CAR_WIDTH, CAR_HEIGHT, FOCAL_SCALE, SIZE_SCALE
-        FRAME_WIDTH = args.FRAME_WIDTH
-        FRAME_HEIGHT = args.FRAME_HEIGHT
-        BEV_WIDTH = args.BEV_WIDTH
-        BEV_HEIGHT = args.BEV_HEIGHT
-        CAR_WIDTH = args.CAR_WIDTH
-        CAR_HEIGHT = args.CAR_HEIGHT
-        FOCAL_SCALE = args.FOCAL_SCALE
-        SIZE_SCALE = args.SIZE_SCALE
-
-    def __call__(self, front, back, left, right, car = None):
-        images = [front,back,left,right]
-        if self.balance:
-            images = luminance_balance(images)
-        images = [mask(camera.raw2bev(img)) 
-                  for img, mask, camera in zip(images, self.masks, self.cameras)]
-        surround = cv2.add(images[0],images[1])
-        surround = cv2.add(surround,images[2])
-        surround = cv2.add(surround,images[3])
-        if self.balance:
-            surround = color_balance(surround)
+        # the default config, used by every BevGenerator created without config=
+        return default_config
+
+    def get_car_rect(self):
+        BEV_WIDTH, BEV_HEIGHT = self.config.BEV_WIDTH, self.config.BEV_HEIGHT
+        CAR_WIDTH, CAR_HEIGHT = self.config.CAR_WIDTH, self.config.CAR_HEIGHT
+        x = max(int((BEV_WIDTH - CAR_WIDTH) / 2), 0)
+        y = max(int((BEV_HEIGHT - CAR_HEIGHT) / 2), 0)
+        return (x, y, min(CAR_WIDTH, BEV_WIDTH - x), min(CAR_HEIGHT, BEV_HEIGHT - y))
+
+    def get_level(self, scale):
+        # every other scale gets its own fused maps sampling the raw frames directly
+        width, height = round(self.config.BEV_WIDTH * scale), round(self.config.BEV_HEIGHT * scale)
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        weights = [cv2.resize(mask.mask, (width, height), interpolation=interpolation) for mask in self.masks]
+        x, y, w, h = self.car_rect
+        x0, y0 = round(x * scale), round(y * scale)
+        car_rect = (x0, y0, round((x + w) * scale) - x0, round((y + h) * scale) - y0)
+        with metrics.stage('bev.level_lut'):
+            return FusedLUT([camera.get_bev_maps(scale) for camera in self.cameras], weights, self.frame_size, car_rect)
+
+    def get_level_car(self, car, scale):
+        x, y, w, h = self.levels[scale].car_rect
+        return cv2.resize(car, (w, h), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+
+    def get_car(self, car):
+        # accepts the car image itself or the car padded to the BEV size
+        x, y, w, h = self.car_rect
+        width, height = self.config.BEV_WIDTH, self.config.BEV_HEIGHT
+        if car.shape[:2] == (height, width):
+            # the padding must be black, otherwise the car is larger than CAR_WIDTH x CAR_HEIGHT and would be cut off
+            if car[:y].any() or car[y+h:].any() or car[y:y+h, :x].any() or car[y:y+h, x+w:].any():
+                raise Exception("car image is larger than {}x{}, set CAR_WIDTH/CAR_HEIGHT to its size".format(w, h))
+            return car[y:y+h, x:x+w]
+        if car.shape[:2] != (h, w):
+            raise Exception("car image should be {}x{} or {}x{}".format(w, h, width, height))
+        return car
+
+    def set_car(self, car, alpha=None):
+        # alpha: 0~255 mask, the car is blended over the rendered surround instead of replacing it
+        car = self.get_car(car)
+        self.car_alpha, self.car_alphas = None, {}
+        if alpha is not None:
+            alpha = self.get_car(alpha)
+            car = fixed_blend(car, fixed_weight(alpha))
+            self.car_alpha = np.ascontiguousarray(fixed_weight(255 - alpha))
+            self.car_alphas = {scale: fixed_weight(255 - self.get_level_car(alpha, scale)) for scale in self.levels}
+        self.car = np.ascontiguousarray(car)
+        self.cars = {scale: self.get_level_car(self.car, scale) for scale in self.levels}
+
+    def dispatch(self, func, *iterables):
+        if self.executor is None:
+            return list(map(func, *iterables))
+        return list(self.executor.map(func, *iterables))
+
+    def get_buffer(self, i, img):
+        x, y, w, h = self.cameras[i].rect
+        shape = (h, w) + img.shape[2:]
+        if self.buffers[i] is None or self.buffers[i].shape != shape or self.buffers[i].dtype != img.dtype:
+            self.buffers[i] = np.empty(shape, dtype=img.dtype)
+        return self.buffers[i]
+
+    def render_camera(self, i, img, lut):
+        remap, lut_stage, mask = self.stages[i]
+        with metrics.stage(remap):
+            bev = self.cameras[i].raw2bev(img, self.get_buffer(i, img))
+        if lut is not None:
+            with metrics.stage(lut_stage):
+                cv2.LUT(bev, lut, dst=bev)
+        with metrics.stage(mask):
+            return self.masks[i].apply(bev)
+
+    def check_allocations(self, front, back, left, right, car = None, out = None, calls = 3):
+        # peak bytes allocated by calls after a warm-up call, close to 0 in steady state
+        self(front, back, left, right, car, out)
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        for _ in range(calls):
+            self(front, back, left, right, car, out)
+        peak = tracemalloc.get_traced_memory()[1] - base
+        if not tracing:
+            tracemalloc.stop()
+        return peak
+
+    def __call__(self, front, back, left, right, car = None, out = None, luts = None):
+        # luts: overlap balance LUTs computed elsewhere, eg. by BevBatch in order before the frames are spread out
+        with metrics.stage('bev.frame'):
+            images = [front,back,left,right]
+            with metrics.stage('bev.balance'):
+                if self.balancer is not None:
+                    if luts is None:
+                        luts = self.balancer(images)
+                elif self.balance:
+                    images = luminance_balance(images, self.dispatch)
+            stack = None
+            if self.fused or self.levels:
+                # the frames are read once into a stack shared by every fused level
+                lut = self.lut if self.fused else next(iter(self.levels.values()))
+                with metrics.stage('bev.stack'):
+                    stack = lut.get_stack(images, luts)
+            if self.scales is None:
+                return self.render(images, luts, stack, car, out)
+            outs = out if out is not None else [None] * len(self.scales)
+            return [self.render(images, luts, stack, car, o, scale) for scale, o in zip(self.scales, outs)]
+
+    def render(self, images, luts, stack, car, out, scale = 1):
+        car_rect = self.car_rect
+        alpha = None
         if car is not None:
-            surround = cv2.add(surround,car)
+            car = self.get_car(car)
+            if scale != 1:
+                car = self.get_level_car(car, scale)
+        elif self.car is not None:
+            car = self.car if scale == 1 else self.cars[scale]
+            if self.car_alpha is not None:
+                alpha = self.car_alpha if scale == 1 else self.car_alphas[scale]
+        # the footprint is only skipped if nothing reads it before an opaque car is drawn over it
+        covered = car is not None and alpha is None and not (self.balance and self.balancer is None)
+        if scale != 1:
+            with metrics.stage('bev.level'):
+                surround = self.levels[scale].render(stack, out, covered)
+            car_rect = self.levels[scale].car_rect
+        elif self.fused:
+            with metrics.stage('bev.fused'):
+                surround = self.lut.render(stack, out, covered)
+        else:
+            bevs = self.dispatch(self.render_camera, range(4), images, luts or [None] * 4)
+            with metrics.stage('bev.add'):
+                if out is None:
+                    surround = np.zeros((self.config.BEV_HEIGHT, self.config.BEV_WIDTH) + images[0].shape[2:],
+                                        dtype=images[0].dtype)
+                else:
+                    surround = out
+                    surround.fill(0)
+                for bev, mask, camera in zip(bevs, self.masks, self.cameras):
+                    x, y, w, h = camera.rect
+                    roi = surround[y:y+h, x:x+w]
+                    cv2.add(roi, bev, dst=roi, mask=mask.area)
+        if self.balance and self.balancer is None:
+            with metrics.stage('bev.color_balance'):
+                surround = color_balance(surround)
+                if out is not None:
+                    out[...] = surround
+                    surround = out
+        if car is not None:
+            with metrics.stage('bev.car'):
+                x, y, w, h = car_rect
+                roi = surround[y:y+h, x:x+w]
+                if alpha is None:
+                    roi[...] = car
+                else:
+                    fixed_blend(roi, alpha, out=roi)
+                    cv2.add(roi, car, dst=roi)
         return surround
 
-def main():
+def save_bundle(path, config=None, maps=True):
+    # K/D/H of the four cameras (from DATA_PATH or BUNDLE_PATH) with their full BEV maps for this geometry
+    config = config if config is not None else default_config
+    bundle = CalibBundle(config.BUNDLE_PATH) if config.BUNDLE_PATH is not None else None
+    cameras = {}
+    for name in ['front', 'back', 'left', 'right']:
+        camera = Camera(name, config, bundle=bundle)
+        arrays = {'K': camera.camera_mat, 'D': camera.dist_coeff, 'H': camera.homography}
+        if maps:
+            arrays['bev1'], arrays['bev2'] = camera.bev_maps
+        cameras[name] = {'arrays': arrays, 'info': {'image_size': [config.FRAME_WIDTH, config.FRAME_HEIGHT]}}
+    write_bundle(path, cameras, {'maps': get_map_geometry(config)} if maps else {})
+
+def render_worker(bev, inputs, outputs, car, tasks, done):
+    # runs in a forked process, bev and its maps are shared copy-on-write with the parent
+    bev.executor = None
+    while True:
+        task = tasks.get()
+        if task is None: break
+        index, slot, luts = task
+        try:
+            bev(*inputs[slot], car, out=outputs[slot], luts=luts)
+            done.put((index, slot, None))
+        except Exception:
+            done.put((index, slot, traceback.format_exc()))
+
+class BevBatch:
+    def __init__(self, bev, processes=None, car=None, slots=None):
+        if bev.scales is not None:
+            raise Exception("batch mode renders a single scale, create BevGenerator without scales")
+        self.bev = bev
+        processes = processes if processes is not None else bev.config.PROCESSES
+        self.processes = processes if processes > 0 else os.cpu_count()
+        self.slots = slots if slots is not None else 2 * self.processes
+        self.car = car
+
+    def start(self, frames):
+        # one shared memory block per slot holding the four input frames and the output
+        frame_size = frames[0].nbytes
+        out_shape = (self.bev.config.BEV_HEIGHT, self.bev.config.BEV_WIDTH) + frames[0].shape[2:]
+        out_size = int(np.prod(out_shape)) * frames[0].itemsize
+        self.shm = [shared_memory.SharedMemory(create=True, size=4 * frame_size + out_size)
+                    for _ in range(self.slots)]
+        self.inputs = [[np.ndarray(frames[0].shape, frames[0].dtype, shm.buf, i * frame_size) for i in range(4)]
+                       for shm in self.shm]
+        self.outputs = [np.ndarray(out_shape, frames[0].dtype, shm.buf, 4 * frame_size) for shm in self.shm]
+        context = multiprocessing.get_context('fork')
+        self.tasks = context.Queue()
+        self.done = context.Queue()
+        self.workers = [context.Process(target=render_worker, daemon=True,
+                                        args=(self.bev, self.inputs, self.outputs, self.car, self.tasks, self.done))
+                        for _ in range(self.processes)]
+        for worker in self.workers:
+            worker.start()
+
+    def close(self):
+        # closes the generator the batch renders with
+        self.bev.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def stop(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.inputs = self.outputs = None
+        for shm in self.shm:
+            shm.close()
+            shm.unlink()
+
+    def __call__(self, frame_sets):
+        frame_sets = iter(frame_sets)
+        free = list(range(self.slots))
+        pending = {}
+        submitted = 0
+        returned = 0
+        exhausted = False
+        started = False
+        try:
+            while True:
+                while free and not exhausted:
+                    frames = next(frame_sets, None)
+                    if frames is None:
+                        exhausted = True
+                        break
+                    if not started:
+                        self.start(frames)
+                        started = True
+                    slot = free.pop()
+                    for dst, frame in zip(self.inputs[slot], frames):
+                        if frame.shape != dst.shape:
+                            raise Exception("all frames should be {}".format(dst.shape))
+                        np.copyto(dst, frame)
+                    # the balance follows the frames over time, so it runs here in frame order
+                    # instead of on whichever worker gets the frame
+                    luts = None
+                    if self.bev.balancer is not None:
+                        with metrics.stage('bev.balance'):
+                            luts = self.bev.balancer(frames)
+                    self.tasks.put((submitted, slot, luts))
+                    submitted += 1
+                if exhausted and returned == submitted:
+                    break
+                while returned not in pending:
+                    index, slot, error = self.done.get()
+                    if error is not None:
+                        raise Exception("BEV worker failed:\n" + error)
+                    pending[index] = slot
+                slot = pending.pop(returned)
+                yield self.outputs[slot].copy()
+                free.append(slot)
+                returned += 1
+        finally:
+            if started:
+                self.stop()
+
+class FrameSource:
+    def __init__(self, path, name):
+        folder = os.path.join(path, name)
+        if os.path.isdir(folder):
+            # image folder named by timestamp, as used by timeAlign.py, other files are skipped
+            self.cap = None
+            self.files = {}
+            for x in os.listdir(folder):
+                try:
+                    self.files[float(os.path.splitext(x)[0])] = os.path.join(folder, x)
+                except ValueError:
+                    continue
+            self.times = sorted(self.files)
+            if len(self.times) == 0:
+                raise Exception("no images named by timestamp in {}".format(folder))
+        else:
+            videos = [x for x in os.listdir(path) if os.path.splitext(x)[0] == name]
+            if len(videos) == 0:
+                raise Exception("from {} read {} video/images failed".format(path, name))
+            self.file = os.path.join(path, videos[0])
+            self.cap = cv2.VideoCapture(self.file)
+            if not self.cap.isOpened():
+                raise Exception("from {} read video failed".format(self.file))
+            fps = self.cap.get(cv2.CAP_PROP_FPS)
+            if not fps > 0:
+                raise Exception("video {} has no frame rate, extract its frames to {} named by timestamp"
+                                .format(self.file, folder))
+            count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            if count <= 0:
+                count = self.count_frames()
+            # align_time needs timestamps above 0, so each frame is stamped at its end
+            self.times = [(i + 1) / fps for i in range(count)]
+            if count == 0:
+                raise Exception("no frames in video {}".format(self.file))
+            self.frames = {t: i for i, t in enumerate(self.times)}
+            self.index = 0
+
+    def count_frames(self):
+        # some containers do not store the frame count, the video is read through once instead
+        count = 0
+        while self.cap.grab():
+            count += 1
+        self.cap.release()
+        self.cap = cv2.VideoCapture(self.file)
+        return count
+
+    def read(self, t):
+        # None once the video ends, which can be before the frame count in its header
+        if self.cap is None:
+            frame = cv2.imread(self.files[t])
+            if frame is None:
+                raise Exception("read image {} failed".format(self.files[t]))
+            return frame
+        target = self.frames[t]
+        while self.index < target and self.cap.grab():
+            self.index += 1
+        ok, frame = self.cap.read() if self.index == target else (False, None)
+        if not ok:
+            print("{} ended at frame {} of {}".format(self.file, self.index, len(self.times)))
+            return None
+        self.index += 1
+        return frame
+
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
+
+class StreamQueue(queue.Queue):
+    def __init__(self, maxsize, stop=None):
+        # stop: event set when the stream fails, a blocked put gives up and a blocked get returns None
+        super().__init__(maxsize)
+        self.stop = stop if stop is not None else threading.Event()
+        self.wait = 0
+        self.depth = 0
+        self.count = 0
+
+    def put(self, item):
+        self.depth += self.qsize()
+        self.count += 1
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                super().put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.wait += time.perf_counter() - start
+
+    def get(self):
+        while True:
+            try:
+                return super().get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return None
+
+    def stats(self):
+        return {'mean_depth': self.depth / max(self.count, 1), 'full_wait': self.wait}
+
+class BevStream:
+    def __init__(self, bev, path, output=None, fps=None, queue_size=None, thresh=None, car=None, processes=None):
+        if bev.scales is not None:
+            raise Exception("stream mode renders a single scale, create BevGenerator without scales")
+        c = bev.config
+        output = output if output is not None else c.OUTPUT_FILE
+        fps = fps if fps is not None else c.OUTPUT_FPS
+        queue_size = queue_size if queue_size is not None else c.QUEUE_SIZE
+        thresh = thresh if thresh is not None else c.ALIGN_THRESH
+        processes = processes if processes is not None else c.PROCESSES
+        self.bev = bev
+        self.batch = BevBatch(bev, processes, car) if processes > 0 else None
+        self.names = ['front', 'back', 'left', 'right']
+        self.sources = [FrameSource(path, name) for name in self.names]
+        self.times = self.align(thresh)
+        self.output = output
+        self.fps = fps
+        self.car = car
+        self.stop = threading.Event()
+        self.decoded = StreamQueue(queue_size, self.stop)
+        self.rendered = StreamQueue(queue_size, self.stop)
+        self.error = None
+
+    def align(self, thresh):
+        # image folders are stamped by the capture clock, videos from their first frame, so when both
+        # are mixed every source is aligned from its own first frame (moved to 1s, align_time needs times above 0)
+        mixed = len(set(source.cap is None for source in self.sources)) > 1
+        times = {}
+        for name, source in zip(self.names, self.sources):
+            offset = 1 - source.times[0] if mixed else 0
+            times[name] = {t + offset: t for t in source.times}
+        final, cams = align_time({name: list(stamps) for name, stamps in times.items()}, thresh)
+        return [[times[name][group[cams.index(name)]] for name in self.names] for group in final if len(group) == 4]
+
+    def run_stage(self, func, src, dst):
+        try:
+            if src is None:
+                for times in self.times:
+                    if self.stop.is_set(): break
+                    item = func(times)
+                    if item is None: break
+                    dst.put(item)
+            else:
+                while True:
+                    item = src.get()
+                    if item is None or self.stop.is_set(): break
+                    dst.put(func(item))
+        except Exception as e:
+            self.error = e
+            self.stop.set()
+        finally:
+            dst.put(None)
+
+    def run_batch(self):
+        try:
+            for surround in self.batch(iter(self.decoded.get, None)):
+                if self.stop.is_set(): break
+                self.rendered.put(surround)
+        except Exception as e:
+            self.error = e
+            self.stop.set()
+        finally:
+            self.rendered.put(None)
+
+    def close(self):
+        # closes the sources and the generator the stream renders with
+        for source in self.sources:
+            source.release()
+        self.bev.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def decode(self, times):
+        with metrics.stage('stream.decode'):
+            frames = [source.read(t) for source, t in zip(self.sources, times)]
+        # the stream stops at the end of the shortest video
+        return None if any(frame is None for frame in frames) else frames
+
+    def render(self, frames):
+        return self.bev(*frames, self.car)
+
+    def __call__(self):
+        writer = None
+        if self.batch is None:
+            render = threading.Thread(target=self.run_stage, args=(self.render, self.decoded, self.rendered), daemon=True)
+        else:
+            render = threading.Thread(target=self.run_batch, daemon=True)
+        threads = [threading.Thread(target=self.run_stage, args=(self.decode, None, self.decoded), daemon=True), render]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        frames = 0
+        try:
+            while True:
+                surround = self.rendered.get()
+                if surround is None: break
+                if writer is None:
+                    writer = cv2.VideoWriter(self.output, cv2.VideoWriter_fourcc('M','P','4','V'), 
+                                             self.fps, surround.shape[1::-1])
+                with metrics.stage('stream.encode'):
+                    writer.write(surround)
+                frames += 1
+                if frames % 100 == 0:
+                    print("{} frames, {:.1f} FPS".format(frames, frames / (time.perf_counter() - start)))
+        finally:
+            # stops the decode and render threads if they are still running, eg. after an error here
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            if writer is not None:
+                writer.release()
+            for source in self.sources:
+                source.release()
+        if self.error is not None:
+            raise self.error
+        return {'frames': frames, 'seconds': elapsed, 'fps': frames / max(elapsed, 1e-9),
+                'decode_queue': self.decoded.stats(), 'render_queue': self.rendered.stats()}
+
+def main(args=None):
+    args = args if args is not None else parse_args()
+    if args.METRICS_PATH is not None:
+        metrics.enable()
+    if args.SAVE_BUNDLE is not None:
+        save_bundle(args.SAVE_BUNDLE, args)
+        print("calibration bundle written to {}".format(args.SAVE_BUNDLE))
+        return
+    if args.STREAM_PATH is not None:
+        car = cv2.imread('./data/car.jpg')
+        car = padding(car, args.BEV_WIDTH, args.BEV_HEIGHT) if car is not None else None
+        with BevStream(BevGenerator(config=args), args.STREAM_PATH, car=car) as stream:
+            stats = stream()
+        print("{} frames in {:.1f}s, sustained {:.1f} FPS".format(stats['frames'], stats['seconds'], stats['fps']))
+        print("decode queue: {}".format(stats['decode_queue']))
+        print("render queue: {}".format(stats['render_queue']))
+        if args.METRICS_PATH is not None:
+            metrics.write(args.METRICS_PATH)
+        return
     front = cv2.imread('./data/front/front.jpg')
     back = cv2.imread('./data/back/back.jpg')
     left = cv2.imread('./data/left/left.jpg')
     right = cv2.imread('./data/right/right.jpg')
     car = cv2.imread('./data/car.jpg')
-    car = padding(car, BEV_WIDTH, BEV_HEIGHT)
+    car = padding(car, args.BEV_WIDTH, args.BEV_HEIGHT)
     
-    bev = BevGenerator()
-    surround = bev(front,back,left,right,car)
+    with BevGenerator(config=args) as bev:
+        surround = bev(front,back,left,right,car)
+    if args.SCALES is not None:
+        for scale, img in zip(args.SCALES, surround):
+            cv2.imwrite('./surround_{}.jpg'.format(scale), img)
+        surround = surround[0]
     
     cv2.namedWindow('surround', flags = cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
     cv2.imshow('surround', surround)
     cv2.imwrite('./surround.jpg', surround)
+    if args.METRICS_PATH is not None:
+        metrics.write(args.METRICS_PATH)
     cv2.waitKey(0)
     cv2.destroyAllWindows()
 
@@ -0,0 +1,8 @@
+"""
+Shared tools of the calibration and BEV packages, imported from the repo root
+
+    from Tools.stageMetrics import metrics
+    from Tools.calibBundle import CalibBundle
+
+The scripts in this folder (collect.py, calibBundle.py, benchmark.py, ...) still run from it directly.
+"""
@@ -0,0 +1,352 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+
+parser = argparse.ArgumentParser(description="Benchmark BEV Generation and Calibration on Synthetic Data")
+parser.add_argument('-suites', '--SUITES', default=['bev', 'incalib', 'excalib'], type=str, nargs='+', help='Benchmark Suites: bev/incalib/excalib')
+parser.add_argument('-sizes', '--BEV_SIZES', default=[500, 1000, 1500], type=int, nargs='+', help='BEV Sizes to Benchmark (square, pixel)')
+parser.add_argument('-frames', '--FRAME_NUMBERS', default=[5, 10, 20], type=int, nargs='+', help='Calibration Frame Numbers to Benchmark')
+parser.add_argument('-detect_scales', '--DETECT_SCALES', default=[0.5, 0.25], type=float, nargs='+', help='Downscaled Chessboard Search Scales to Compare with Full Resolution')
+parser.add_argument('-type', '--CAMERA_TYPE', default='fisheye', type=str, help='Camera Type of Intrinsic Calibration: fisheye/normal')
+parser.add_argument('-repeat', '--REPEAT', default=20, type=int, help='Timed Runs of Each Per-Frame Case')
+parser.add_argument('-repeat_init', '--REPEAT_INIT', default=3, type=int, help='Timed Runs of Each Construction/Calibration Case')
+parser.add_argument('-warmup', '--WARMUP', default=2, type=int, help='Untimed Runs before Each Per-Frame Case')
+parser.add_argument('-output', '--OUTPUT_FILE', default='benchmark.json', type=str, help='Output JSON File')
+parser.add_argument('-baseline', '--BASELINE_FILE', default=None, type=str, help='Baseline JSON File to Compare (None to skip)')
+parser.add_argument('-tolerance', '--TOLERANCE', default=0.2, type=float, help='Allowed p50 Slowdown against Baseline (0.2 for 20%%)')
+parser.add_argument('-psnr', '--PSNR_THRESH', default=40, type=float, help='Min PSNR of Accelerated BEV Paths against Reference (dB)')
+parser.add_argument('-seed', '--SEED', default=0, type=int, help='Random Seed of Synthetic Data')
+args = parser.parse_args()
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from IntrinsicCalibration import InCalibrator, InCalibConfig
+from ExtrinsicCalibration import ExCalibrator, ExCalibConfig
+from SurroundBirdEyeView import BevGenerator, BevConfig
+from SurroundBirdEyeView.surroundBEV import BlendMask
+
+def summarize(times):
+    times = np.array(times) * 1000
+    return {'unit': 'ms', 'n': len(times), 'mean': float(np.mean(times)), 'min': float(np.min(times)),
+            'p50': float(np.percentile(times, 50)), 'p90': float(np.percentile(times, 90)),
+            'p99': float(np.percentile(times, 99)), 'max': float(np.max(times))}
+
+def measure(func, repeat, warmup=0, setup=None):
+    # setup runs untimed before each call and returns the call arguments
+    for _ in range(warmup):
+        func(*(setup() if setup is not None else ()))
+    times = []
+    for _ in range(repeat):
+        params = setup() if setup is not None else ()
+        start = time.perf_counter()
+        func(*params)
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+def psnr(img, ref):
+    mse = np.mean((img.astype(np.float64) - ref.astype(np.float64)) ** 2)
+    return 100.0 if mse == 0 else float(min(10 * np.log10(255 ** 2 / mse), 100.0))
+
+def get_camera_mat(width, height):
+    return np.array([[350., 0, width / 2], [0, 350., height / 2], [0, 0, 1]])
+
+def get_rotation(forward, down):
+    # world to camera rotation, camera x to the right of view, y down in image, z along the optical axis
+    z = forward / np.linalg.norm(forward)
+    x = np.cross(down, z)
+    x /= np.linalg.norm(x)
+    y = np.cross(z, x)
+    return np.stack([x, y, z])
+
+def write_bev_calib(path, bev_args):
+    # four fisheye cameras 1m above the ground looking outwards 45 degrees down,
+    # the BEV always covers 10m x 10m so every size sees the same scene
+    meter = 10 / bev_args.BEV_WIDTH
+    poses = {'front': ((0, -2.0), (0, -1)), 'back': ((0, 2.0), (0, 1)),
+             'left': ((-1.25, 0), (-1, 0)), 'right': ((1.25, 0), (1, 0))}
+    K = get_camera_mat(bev_args.FRAME_WIDTH, bev_args.FRAME_HEIGHT)
+    D = np.array([[0.05], [-0.01], [0.002], [-0.0005]])
+    K_dst = K.copy()
+    K_dst[0][0] *= bev_args.FOCAL_SCALE
+    K_dst[1][1] *= bev_args.FOCAL_SCALE
+    K_dst[0][2] = bev_args.FRAME_WIDTH / 2 * bev_args.SIZE_SCALE
+    K_dst[1][2] = bev_args.FRAME_HEIGHT / 2 * bev_args.SIZE_SCALE
+    bev2ground = np.array([[meter, 0, -bev_args.BEV_WIDTH / 2 * meter],
+                           [0, meter, -bev_args.BEV_HEIGHT / 2 * meter],
+                           [0, 0, 1]])
+    for name, ((x, y), (dx, dy)) in poses.items():
+        R = get_rotation(np.array([dx, dy, 1.]), np.array([0, 0, 1.]))
+        t = -R @ np.array([x, y, -1.])
+        ground2undist = K_dst @ np.stack([R[:, 0], R[:, 1], t], axis=1) @ bev2ground
+        H = np.linalg.inv(ground2undist)
+        os.makedirs(os.path.join(path, name), exist_ok=True)
+        np.save(os.path.join(path, name, 'camera_{}_K.npy'.format(name)), K)
+        np.save(os.path.join(path, name, 'camera_{}_D.npy'.format(name)), D)
+        np.save(os.path.join(path, name, 'camera_{}_H.npy'.format(name)), H / H[2, 2])
+
+def get_bev_frames(rng, width, height):
+    # smooth random texture with a different exposure per camera, so balancing has work to do
+    frames = []
+    for gain in [1.0, 0.8, 1.15, 0.9]:
+        noise = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+        frame = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+        frames.append(cv2.convertScaleAbs(frame, alpha=gain))
+    return frames
+
+def get_bev_config(size, path):
+    return BevConfig(BEV_WIDTH=size, BEV_HEIGHT=size, CAR_WIDTH=round(250 * size / 1000),
+                     CAR_HEIGHT=round(400 * size / 1000), DATA_PATH=path)
+
+def bench_bev(results, psnrs, rng, tmp):
+    frames = get_bev_frames(rng, BevConfig.FRAME_WIDTH, BevConfig.FRAME_HEIGHT)
+    for size in args.BEV_SIZES:
+        path = os.path.join(tmp, 'bev_{}'.format(size))
+        bev_args = get_bev_config(size, path)
+        write_bev_calib(path, bev_args)
+        for blend in [False, True]:
+            for balance in [False, True]:
+                name = 'bev/{}/blend{}/balance{}'.format(size, int(blend), int(balance))
+                print(name)
+                results[name + '/init'] = measure(
+                    lambda: BevGenerator(blend=blend, balance=balance, config=bev_args),
+                    args.REPEAT_INIT, setup=lambda: BlendMask.cache.clear() or ())
+                reference = BevGenerator(blend=blend, balance=balance, config=bev_args)
+                results[name + '/call'] = measure(lambda: reference(*frames), args.REPEAT, args.WARMUP)
+                fused = BevGenerator(blend=blend, balance=balance, fused=True, config=bev_args)
+                results[name + '/fused/call'] = measure(lambda: fused(*frames), args.REPEAT, args.WARMUP)
+                check_bev(psnrs, name, frames, blend, balance, bev_args, os.path.join(tmp, 'cache'))
+
+def check_bev(psnrs, name, frames, blend, balance, config, cache):
+    # every accelerated path starts from a fresh generator so the balance gains match the reference
+    ref = BevGenerator(blend=blend, balance=balance, config=config)(*frames)
+    variants = {'fused': dict(fused=True), 'workers': dict(workers=4), 'cache': dict(cache=cache)}
+    for variant, kwargs in variants.items():
+        if variant == 'cache':
+            BevGenerator(blend=blend, balance=balance, config=config, **kwargs)
+        bev = BevGenerator(blend=blend, balance=balance, config=config, **kwargs)
+        psnrs[name + '/' + variant] = psnr(bev(*frames), ref)
+    out = np.empty_like(ref)
+    BevGenerator(blend=blend, balance=balance, config=config)(*frames, out=out)
+    psnrs[name + '/out'] = psnr(out, ref)
+
+def get_board(in_args, square):
+    # white margin of one square around (BORAD_WIDTH+1) x (BORAD_HEIGHT+1) squares
+    rows, cols = in_args.BORAD_HEIGHT + 1, in_args.BORAD_WIDTH + 1
+    board = np.full(((rows + 2) * square, (cols + 2) * square), 255, dtype=np.uint8)
+    for i in range(rows):
+        for j in range(cols):
+            if (i + j) % 2 == 0:
+                board[(i + 1) * square:(i + 2) * square, (j + 1) * square:(j + 2) * square] = 0
+    # board pixel -> board plane, inner corner (j, i) at (j, i) * SQUARE_SIZE like InCalibrator
+    scale = in_args.SQUARE_SIZE / square
+    board2plane = np.array([[scale, 0, -2 * square * scale], [0, scale, -2 * square * scale], [0, 0, 1]])
+    return board, board2plane
+
+def get_rays(K, D, width, height, camera_type):
+    # normalized undistorted coordinates of every raw pixel
+    u, v = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+    points = np.stack([u, v], axis=-1).reshape(-1, 1, 2)
+    if camera_type == 'fisheye':
+        rays = cv2.fisheye.undistortPoints(points, K, D)
+    else:
+        rays = cv2.undistortPoints(points, K, D)
+    return rays.reshape(height, width, 2)
+
+def render_board(rng, board, board2plane, rays, in_args):
+    # random pose facing the camera, then pull every raw pixel back onto the board
+    rvec = rng.uniform(-0.6, 0.6, 3) * np.array([1, 1, 0.3])
+    R = cv2.Rodrigues(rvec)[0]
+    center = np.array([in_args.BORAD_WIDTH - 1, in_args.BORAD_HEIGHT - 1, 0]) * in_args.SQUARE_SIZE / 2
+    distance = rng.uniform(0.6, 1.0) * in_args.BORAD_WIDTH * in_args.SQUARE_SIZE
+    offset = rng.uniform(-0.3, 0.3, 2) * distance
+    t = -R @ center + np.array([offset[0], offset[1], distance])
+    plane2ray = np.stack([R[:, 0], R[:, 1], t], axis=1)
+    G = np.linalg.inv(plane2ray @ board2plane)
+    x, y = rays[..., 0], rays[..., 1]
+    Z = G[2, 0] * x + G[2, 1] * y + G[2, 2]
+    map_x = ((G[0, 0] * x + G[0, 1] * y + G[0, 2]) / Z).astype(np.float32)
+    map_y = ((G[1, 0] * x + G[1, 1] * y + G[1, 2]) / Z).astype(np.float32)
+    gray = cv2.remap(board, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=128)
+    gray = cv2.add(gray, rng.integers(0, 8, gray.shape, dtype=np.uint8))
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+def get_calib_frames(rng, count, in_args, camera_type):
+    width, height = in_args.FRAME_WIDTH, in_args.FRAME_HEIGHT
+    K = get_camera_mat(width, height)
+    D = np.array([[0.05], [-0.01], [0.002], [-0.0005]]) if camera_type == 'fisheye' else np.zeros((5, 1))
+    board, board2plane = get_board(in_args, 40)
+    rays = get_rays(K, D, width, height, camera_type)
+    frames = []
+    corners = []
+    for _ in range(10 * count):
+        if len(frames) == count:
+            break
+        frame = render_board(rng, board, board2plane, rays, in_args)
+        ok, found = is_usable(frame, corners, camera_type)
+        if ok:
+            frames.append(frame)
+            corners.append(found)
+    if len(frames) < count:
+        raise Exception("only {} of {} synthetic calibration frames usable".format(len(frames), count))
+    return frames
+
+def is_usable(frame, corners, camera_type):
+    # cv2.fisheye.calibrate fails on some view sets, so a frame is kept only if
+    # it still calibrates together with the frames kept before it
+    calibrator = InCalibrator(camera_type)
+    ok, found = calibrator.get_corners(frame)
+    if not ok:
+        return False, None
+    try:
+        calibrator.camera.update(corners + [found], frame.shape[1::-1])
+    except cv2.error:
+        return False, None
+    return bool(calibrator.camera.data.ok), found
+
+def bench_detect_scales(results, corner_errs, prefix, frames, detections):
+    # downscaled search against the full resolution corners of the same frames
+    for scale in args.DETECT_SCALES:
+        calibrator = InCalibrator(args.CAMERA_TYPE, InCalibConfig(DETECT_SCALE=scale))
+        times = []
+        errs = []
+        found = 0
+        for frame, full in zip(frames, detections):
+            start = time.perf_counter()
+            ok, corners = calibrator.get_corners(frame)
+            times.append(time.perf_counter() - start)
+            found += int(ok)
+            if ok and full is not None:
+                errs.append(np.linalg.norm((corners - full).reshape(-1, 2), axis=1))
+        name = '{}/detect/scale{}'.format(prefix, scale)
+        results[name] = summarize(times)
+        errs = np.concatenate(errs) if errs else np.zeros(1)
+        corner_errs[name] = {'found': found, 'frames': len(frames),
+                             'mean_px': float(np.mean(errs)), 'max_px': float(np.max(errs))}
+        print('{}: {}/{} boards found'.format(name, found, len(frames)))
+
+def bench_detect_data(results, corner_errs):
+    # the synthetic boards are clean, the sample images show where a downscaled search goes wrong
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'IntrinsicCalibration', 'data')
+    files = sorted(x for x in os.listdir(path) if x.startswith('img_raw')) if os.path.isdir(path) else []
+    if not files:
+        print('incalib/data/detect: skipped')
+        return
+    frames = [cv2.imread(os.path.join(path, x)) for x in files]
+    calibrator = InCalibrator(args.CAMERA_TYPE)
+    detections = []
+    times = []
+    for frame in frames:
+        start = time.perf_counter()
+        ok, corners = calibrator.get_corners(frame)
+        times.append(time.perf_counter() - start)
+        detections.append(corners if ok else None)
+    results['incalib/data/detect'] = summarize(times)
+    bench_detect_scales(results, corner_errs, 'incalib/data', frames, detections)
+
+def bench_incalib(results, corner_errs, rng):
+    in_args = InCalibConfig()
+    frames = get_calib_frames(rng, max(args.FRAME_NUMBERS), in_args, args.CAMERA_TYPE)
+    calibrator = InCalibrator(args.CAMERA_TYPE)
+    detections = []
+    times = []
+    for frame in frames:
+        start = time.perf_counter()
+        ok, corners = calibrator.get_corners(frame)
+        times.append(time.perf_counter() - start)
+        detections.append(corners if ok else None)
+    bench_detect_scales(results, corner_errs, 'incalib/' + args.CAMERA_TYPE, frames, detections)
+    bench_detect_data(results, corner_errs)
+    detections = [corners for corners in detections if corners is not None]
+    print('incalib/{}/detect: {}/{} boards found'.format(args.CAMERA_TYPE, len(detections), len(frames)))
+    results['incalib/{}/detect'.format(args.CAMERA_TYPE)] = summarize(times)
+    for count in args.FRAME_NUMBERS:
+        if count > len(detections) or count < in_args.CALIB_NUMBER:
+            print('incalib/{}/calibrate/{}: skipped'.format(args.CAMERA_TYPE, count))
+            continue
+        def setup():
+            calibrator = InCalibrator(args.CAMERA_TYPE)
+            calibrator.corners = detections[:count]
+            return (calibrator,)
+        name = 'incalib/{}/calibrate/{}'.format(args.CAMERA_TYPE, count)
+        print(name)
+        results[name] = measure(lambda calibrator: calibrator.calibrate(frames[0]), args.REPEAT_INIT, setup=setup)
+
+def bench_excalib(results, rng):
+    ex_args = ExCalibConfig()
+    in_args = InCalibConfig()
+    board_args = argparse.Namespace(BORAD_WIDTH=ex_args.BORAD_WIDTH, BORAD_HEIGHT=ex_args.BORAD_HEIGHT,
+                                    SQUARE_SIZE=in_args.SQUARE_SIZE)
+    board, board2plane = get_board(board_args, 40)
+    width, height = in_args.FRAME_WIDTH, in_args.FRAME_HEIGHT
+    rays = get_rays(get_camera_mat(width, height), np.zeros((5, 1)), width, height, 'normal')
+    src = render_board(rng, board, board2plane, rays, board_args)
+    dst = cv2.cvtColor(cv2.copyMakeBorder(board, 200, 200, 200, 200, cv2.BORDER_CONSTANT, value=128), cv2.COLOR_GRAY2BGR)
+    # get_corners draws on the images, so every run gets fresh copies
+    print('excalib/homography')
+    results['excalib/homography'] = measure(lambda calib, src, dst: calib(src, dst), args.REPEAT, args.WARMUP,
+                                            setup=lambda: (ExCalibrator(), src.copy(), dst.copy()))
+
+def compare(results, baseline):
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        ratio = stats['p50'] / max(baseline[name]['p50'], 1e-9)
+        flag = ''
+        if ratio > 1 + args.TOLERANCE:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<50} {:>10.2f} ms {:>10.2f} ms {:>7.2f}x{}'.format(name, baseline[name]['p50'], stats['p50'], ratio, flag))
+    return regressions
+
+def main():
+    # every suite seeds its own generator, so its data does not depend on the other suites
+    results = {}
+    psnrs = {}
+    corner_errs = {}
+    tmp = tempfile.mkdtemp(prefix='bev_benchmark_')
+    try:
+        if 'bev' in args.SUITES:
+            bench_bev(results, psnrs, np.random.default_rng(args.SEED), tmp)
+        if 'incalib' in args.SUITES:
+            bench_incalib(results, corner_errs, np.random.default_rng(args.SEED))
+        if 'excalib' in args.SUITES:
+            bench_excalib(results, np.random.default_rng(args.SEED))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    failed = [name for name, value in psnrs.items() if value < args.PSNR_THRESH]
+    for name, value in psnrs.items():
+        print('{:<50} PSNR {:6.2f} dB{}'.format(name, value, '  FAILED' if name in failed else ''))
+    for name, err in corner_errs.items():
+        print('{:<50} found {}/{}, corner offset mean {:.3f} px, max {:.3f} px'
+              .format(name, err['found'], err['frames'], err['mean_px'], err['max_px']))
+    regressions = []
+    if args.BASELINE_FILE is not None:
+        with open(args.BASELINE_FILE) as f:
+            regressions = compare(results, json.load(f)['results'])
+    report = {
+        'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+                 'numpy': np.__version__, 'opencv': cv2.__version__, 'platform': platform.platform(),
+                 'cpus': os.cpu_count(), 'args': vars(args)},
+        'results': results,
+        'psnr': psnrs,
+        'psnr_failed': failed,
+        'corner_errs': corner_errs,
+        'regressions': regressions,
+    }
+    with open(args.OUTPUT_FILE, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to {}'.format(args.OUTPUT_FILE))
+    if failed or regressions:
+        raise Exception("{} accelerated paths below {} dB, {} cases slower than baseline"
+                        .format(len(failed), args.PSNR_THRESH, len(regressions)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import struct
+import numpy as np
+
+"""
+Single-file calibration bundle of one vehicle: K, D, H, image sizes and
+optionally the precomputed BEV maps of every camera
+
+    from Tools.calibBundle import CalibBundle, write_bundle, update_bundle
+
+    write_bundle('car.calib', {'front': {'arrays': {'K': K, 'D': D, 'H': H}, 'info': {'image_size': [1280, 1024]}}})
+    update_bundle('car.calib', 'back', {'K': K, 'D': D})    # add or replace arrays of one camera
+    bundle = CalibBundle('car.calib')                       # reads the header only
+    K = bundle.get('front', 'K')                            # memory-mapped on first access
+
+File layout: MAGIC, uint32 version, uint32 0, uint64 header size, JSON header,
+then every array as raw bytes at a 64-byte aligned offset given in the header,
+counted from the first 64-byte boundary after the header.
+"""
+
+MAGIC = b'CALIBBDL'
+VERSION = 1
+ALIGN = 64
+PREFIX = struct.Struct('<8sIIQ')
+
+class CalibBundle:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            prefix = f.read(PREFIX.size)
+            if len(prefix) < PREFIX.size:
+                raise Exception("{} is not a calibration bundle".format(path))
+            magic, version, _, size = PREFIX.unpack(prefix)
+            if magic != MAGIC:
+                raise Exception("{} is not a calibration bundle".format(path))
+            if version > VERSION:
+                raise Exception("bundle version {} of {} is newer than supported version {}".format(version, path, VERSION))
+            header = json.loads(f.read(size).decode())
+        # array offsets in the header count from the first aligned byte after it
+        self.base = get_aligned(PREFIX.size + size)
+        self.version = version
+        self.meta = header['meta']
+        self.entries = header['cameras']
+        self.cameras = list(self.entries)
+        self.mmap = None
+
+    def info(self, name):
+        return self.entries[name]['info'] if name in self.entries else {}
+
+    def has(self, name, key):
+        return name in self.entries and key in self.entries[name]['arrays']
+
+    def get(self, name, key):
+        # read-only view into the mapped file, the file is only mapped on the first call
+        if not self.has(name, key):
+            raise Exception("bundle {} has no {} of camera {}".format(self.path, key, name))
+        if self.mmap is None:
+            self.mmap = np.memmap(self.path, dtype=np.uint8, mode='r')
+        entry = self.entries[name]['arrays'][key]
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        offset = self.base + entry['offset']
+        return self.mmap[offset:offset + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+
+    def load(self, name):
+        # arrays and info of one camera, arrays copied into memory
+        arrays = {key: np.array(self.get(name, key)) for key in self.entries[name]['arrays']}
+        return {'arrays': arrays, 'info': dict(self.info(name))}
+
+def get_aligned(size):
+    return -(-size // ALIGN) * ALIGN
+
+def write_bundle(path, cameras, meta=None):
+    # cameras: {name: {'arrays': {key: array}, 'info': {...}}}, written to a temporary file and replaced atomically
+    entries = {}
+    blocks = []
+    offset = 0
+    for name, camera in cameras.items():
+        arrays = {}
+        for key, array in camera['arrays'].items():
+            array = np.ascontiguousarray(array)
+            arrays[key] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            blocks.append((offset, array))
+            offset += get_aligned(array.nbytes)
+        entries[name] = {'arrays': arrays, 'info': camera.get('info', {})}
+    size = offset
+    header = json.dumps({'meta': meta or {}, 'cameras': entries}).encode()
+    base = get_aligned(PREFIX.size + len(header))
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(PREFIX.pack(MAGIC, VERSION, 0, len(header)))
+        f.write(header)
+        for offset, array in blocks:
+            f.seek(base + offset)
+            f.write(array.tobytes())
+        f.truncate(base + size)
+    os.replace(tmp, path)
+
+def update_bundle(path, name, arrays, info=None, drop=()):
+    # add or replace arrays of one camera, keys in drop (eg. maps made from the old arrays) are removed
+    cameras = {}
+    meta = {}
+    if os.path.exists(path):
+        bundle = CalibBundle(path)
+        meta = bundle.meta
+        cameras = {camera: bundle.load(camera) for camera in bundle.cameras}
+    camera = cameras.setdefault(name, {'arrays': {}, 'info': {}})
+    for key in drop:
+        camera['arrays'].pop(key, None)
+    camera['arrays'].update(arrays)
+    camera['info'].update(info or {})
+    write_bundle(path, cameras, meta)
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack or Show Vehicle Calibration Bundle")
+    parser.add_argument('-data', '--DATA_PATH', default=None, type=str, help='Path of <name>/camera_<name>_K/D/H.npy Files to Pack (None to show)')
+    parser.add_argument('-bundle', '--BUNDLE_PATH', default='./vehicle.calib', type=str, help='Calibration Bundle File')
+    parser.add_argument('-names', '--CAMERA_NAMES', default=['front', 'back', 'left', 'right'], type=str, nargs='+', help='Camera Names to Pack')
+    parser.add_argument('-fw', '--FRAME_WIDTH', default=1280, type=int, help='Camera Frame Width')
+    parser.add_argument('-fh', '--FRAME_HEIGHT', default=1024, type=int, help='Camera Frame Height')
+    args = parser.parse_args()
+    if args.DATA_PATH is not None:
+        cameras = {}
+        for name in args.CAMERA_NAMES:
+            files = {key: os.path.join(args.DATA_PATH, name, 'camera_{}_{}.npy'.format(name, key)) for key in 'KDH'}
+            cameras[name] = {'arrays': {key: np.load(file) for key, file in files.items() if os.path.exists(file)},
+                             'info': {'image_size': [args.FRAME_WIDTH, args.FRAME_HEIGHT]}}
+        write_bundle(args.BUNDLE_PATH, cameras)
+    bundle = CalibBundle(args.BUNDLE_PATH)
+    print("{} (version {})".format(args.BUNDLE_PATH, bundle.version))
+    if bundle.meta:
+        print("meta: {}".format(bundle.meta))
+    for name in bundle.cameras:
+        arrays = bundle.entries[name]['arrays']
+        print("{}: {} {}".format(name, bundle.info(name),
+                                 ', '.join('{}{}'.format(key, tuple(entry['shape'])) for key, entry in arrays.items())))
+
+if __name__ == '__main__':
+    main()
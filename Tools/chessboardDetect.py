@@ -0,0 +1,50 @@
+import cv2
+import numpy as np
+try:
+    from .stageMetrics import metrics
+except ImportError:
+    # run as a script from the Tools folder
+    from stageMetrics import metrics
+
+"""
+Chessboard search on a downscaled copy of the image
+
+    from Tools.chessboardDetect import find_chessboard
+
+    ok, corners = find_chessboard(img, (7, 6), flags, scale=0.5, subpix=11)
+
+Corners are returned in full resolution coordinates, refined by cornerSubPix
+with a subpix x subpix window. With scale < 1 the corners are refined in the
+small copy first, then in the full image; if a corner moves more than
+max_shift pixels there, or does not move at all (no edges in its window),
+the small copy matched it wrong and the search falls back to the full
+resolution image, as it does when no board is found.
+"""
+
+CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+
+def find_chessboard(img, pattern, flags, scale=1, subpix=11, max_shift=1.0):
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    if scale < 1:
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        ok, corners = cv2.findChessboardCorners(small, pattern, flags=flags)
+        if ok:
+            with metrics.stage('chessboard.subpix'):
+                # the window scaled down with the image, but too small a window misses the corner
+                window = max(int(round(subpix * scale)), 5)
+                corners = cv2.cornerSubPix(small, corners, (window, window), (-1, -1), CRITERIA)
+                # pixel centers of the small image back to the full image
+                ratio = np.array([gray.shape[1] / small.shape[1], gray.shape[0] / small.shape[0]], dtype=np.float32)
+                guess = (corners + 0.5) * ratio - 0.5
+                corners = cv2.cornerSubPix(gray, guess.copy(), (subpix, subpix), (-1, -1), CRITERIA)
+            # cornerSubPix leaves a point unchanged when its window holds no edges
+            shift = np.abs(corners - guess).max(axis=2)
+            if shift.max() <= max_shift and shift.min() > 0:
+                return ok, corners
+            metrics.count('chessboard.rejected')
+        metrics.count('chessboard.fallback')
+    ok, corners = cv2.findChessboardCorners(gray, pattern, flags=flags)
+    if ok:
+        with metrics.stage('chessboard.subpix'):
+            corners = cv2.cornerSubPix(gray, corners, (subpix, subpix), (-1, -1), CRITERIA)
+    return ok, corners
@@ -2,6 +2,7 @@ import argparse
 import cv2
 import numpy as np
 import os
+from frameGrabber import FrameGrabber
 
 # 在这里修改各参数值
 parser = argparse.ArgumentParser(description="Control Camera to Collect Data (Image/Video)")
@@ -12,6 +13,7 @@ parser.add_argument('-name', '--SAVE_NAME', default='test', type=str, help='Save
 parser.add_argument('-fw','--FRAME_WIDTH', default=1280, type=int, help='Camera Frame Width')
 parser.add_argument('-fh','--FRAME_HEIGHT', default=720, type=int, help='Camera Frame Height')
 parser.add_argument('-fps','--VIDEO_FPS', default=25, type=int, help='Camera Video Frame per Second')
+parser.add_argument('-buffer','--CAPTURE_BUFFER', default=8, type=int, help='Frames Buffered by Capture Thread')
 args = parser.parse_args()
 
 def main():        
@@ -26,15 +28,18 @@ def main():
     cap.set(cv2.CAP_PROP_FRAME_WIDTH, args.FRAME_WIDTH)                         # 设置相机分辨率
     cap.set(cv2.CAP_PROP_FRAME_HEIGHT, args.FRAME_HEIGHT)
     cap.set(cv2.CAP_PROP_FPS, args.VIDEO_FPS)                                   # 设置相机帧率,请确认相机是否支持
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    cap = FrameGrabber(cap, args.CAPTURE_BUFFER)                                # 在采集线程中读取相机，显示和保存不再阻塞读取
     
     win1 = "camera_{}_frame".format(args.CAMERA_ID)
     win2 = "press y/n to validate"
     index = 0
     while True:                                                                 # 视频输入标定
         key = cv2.waitKey(1)                                                    # 获取键盘输入
-        ok, raw_frame = cap.read()                                              # 从相机读入原始帧
-        if not ok:                               
+        frames = cap.read_all()                                                 # 上次读取之后采集到的所有帧
+        if len(frames) == 0:                               
             raise Exception("camera read failed")                               # 读取视频失败
+        raw_frame = frames[-1][2]                                               # 最新的原始帧
         
         if args.DATA_TYPE == 'image':                                           # 【图像采集模式】
             if key == 32:                                                       # 按空格键采集该帧图像     
@@ -68,7 +73,8 @@ def main():
                     index += 1 
             if flag:
                 win1 = "camera_{}_frame_COLLECTING......".format(args.CAMERA_ID)
-                videoWrite.write(raw_frame)
+                for _, _, frame in frames:                                       # 录制时写入所有帧
+                    videoWrite.write(frame)
 
         cv2.namedWindow(win1, flags = cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)  # 可以手动拖动窗口大小
         cv2.imshow(win1, raw_frame)    
@@ -76,6 +82,7 @@ def main():
 
     cap.release()
     cv2.destroyAllWindows() 
+    print("{} frames captured, {} dropped".format(cap.captured, cap.dropped))
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
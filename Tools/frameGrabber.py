@@ -0,0 +1,85 @@
+import collections
+import threading
+import time
+try:
+    from .stageMetrics import metrics
+except ImportError:
+    # run as a script from the Tools folder
+    from stageMetrics import metrics
+
+"""
+Camera capture in a background thread, so slow processing does not hold back cap.read()
+
+    from Tools.frameGrabber import FrameGrabber
+
+    cap = FrameGrabber(cv2.VideoCapture(0), size=4)
+    ok, frame = cap.read()                          # newest frame, frames skipped since the last read are dropped
+    for index, timestamp, frame in cap.read_all():  # every buffered frame not read yet, eg. for recording
+        ...
+    cap.release()
+
+Frames are kept with their capture index and timestamp in a ring buffer of
+the last size frames, dropped counts the frames no read ever returned.
+"""
+
+class FrameGrabber:
+    def __init__(self, cap, size=4):
+        self.cap = cap
+        self.buffer = collections.deque(maxlen=size)
+        self.cond = threading.Condition()
+        self.captured = 0
+        self.dropped = 0
+        self.last = -1
+        self.ok = True
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            ok, frame = self.cap.read()
+            timestamp = time.time()
+            with self.cond:
+                if not ok:
+                    self.ok = False
+                    self.cond.notify_all()
+                    break
+                self.buffer.append((self.captured, timestamp, frame))
+                self.captured += 1
+                self.cond.notify_all()
+
+    def wait(self, timeout):
+        # True once a frame newer than the last read is buffered
+        return self.cond.wait_for(lambda: not self.ok or (self.buffer and self.buffer[-1][0] > self.last), timeout) \
+               and len(self.buffer) > 0 and self.buffer[-1][0] > self.last
+
+    def take(self, frames):
+        dropped = frames[0][0] - self.last - 1
+        self.dropped += dropped
+        metrics.count('capture.dropped', dropped)
+        self.last = frames[-1][0]
+        return frames
+
+    def read_stamped(self, timeout=2.0):
+        # (ok, frame, timestamp, index) of the newest frame, waits for one not read before
+        with self.cond:
+            if not self.wait(timeout):
+                return False, None, None, None
+            index, timestamp, frame = self.take([self.buffer[-1]])[0]
+        return True, frame, timestamp, index
+
+    def read(self, timeout=2.0):
+        ok, frame, _, _ = self.read_stamped(timeout)
+        return ok, frame
+
+    def read_all(self, timeout=2.0):
+        # [(index, timestamp, frame)] of every buffered frame not read yet, oldest first
+        with self.cond:
+            if not self.wait(timeout):
+                return []
+            return self.take([item for item in self.buffer if item[0] > self.last])
+
+    def release(self):
+        self.running = False
+        self.thread.join()
+        self.cap.release()
@@ -0,0 +1,53 @@
+import cv2
+import os
+import queue
+import threading
+try:
+    from .stageMetrics import metrics
+except ImportError:
+    # run as a script from the Tools folder
+    from stageMetrics import metrics
+
+"""
+Image files written by a background thread, for visualizations of runs without a display
+
+    from Tools.imageWriter import ImageWriter
+
+    writer = ImageWriter('./vis/')
+    writer.write('raw_00001.jpg', img)      # returns at once, img must not be changed afterwards
+    writer.close()                          # waits for the queued images
+
+When more than size images are waiting the new ones are dropped and counted,
+so a slow disk never holds back the caller.
+"""
+
+class ImageWriter:
+    def __init__(self, path, size=16):
+        self.path = path
+        self.queue = queue.Queue(size)
+        self.written = 0
+        self.dropped = 0
+        os.makedirs(self.path, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            name, img = item
+            with metrics.stage('vis.write'):
+                cv2.imwrite(os.path.join(self.path, name), img)
+            self.written += 1
+
+    def write(self, name, img):
+        try:
+            self.queue.put_nowait((name, img))
+        except queue.Full:
+            self.dropped += 1
+            metrics.count('vis.dropped')
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,182 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Per-stage timing and counters shared by BevGenerator, Camera, BlendMask,
+InCalibrator, CalibMode and ExCalibrator
+
+    from Tools.stageMetrics import metrics
+
+    metrics.enable()
+    ...
+    print(metrics.to_json())
+    metrics.write('./metrics.prom')       # for a textfile collector
+    metrics.serve(9100)                   # or scrape http://localhost:9100/metrics
+
+Disabled (the default), metrics.stage() returns one shared no-op context.
+Stages timed in forked BevBatch workers stay in those processes.
+"""
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self, window, buckets):
+        # the last window samples give the percentiles, the buckets count everything since reset
+        self.window = window
+        self.samples = [0.0] * window
+        self.index = 0
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        with self.lock:
+            self.samples[self.index] = value
+            self.index = (self.index + 1) % self.window
+            self.count += 1
+            self.sum += value
+            self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    def snapshot(self):
+        with self.lock:
+            samples = sorted(self.samples[:min(self.count, self.window)])
+            count, total = self.count, self.sum
+            bucket_counts = list(self.bucket_counts)
+        def percentile(q):
+            return samples[min(int(q * len(samples)), len(samples) - 1)] if samples else 0.0
+        return {'count': count, 'sum': total, 'mean': total / count if count else 0.0,
+                'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99),
+                'max': samples[-1] if samples else 0.0, 'window': len(samples),
+                'buckets': bucket_counts}
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class Stage:
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.local = threading.local()
+
+    def __enter__(self):
+        self.local.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.add(time.perf_counter() - self.local.start)
+        return False
+
+class StageMetrics:
+    def __init__(self, window=1024, buckets=BUCKETS, prefix='surround'):
+        self.window = window
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self.enabled = False
+        self.null = NullStage()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+
+    def stage(self, name):
+        # with metrics.stage('bev.remap.front'): ...
+        if not self.enabled:
+            return self.null
+        stage = self.stages.get(name)
+        if stage is None:
+            with self.lock:
+                stage = self.stages.setdefault(name, Stage(Histogram(self.window, self.buckets)))
+        return stage
+
+    def add(self, name, seconds):
+        if self.enabled:
+            self.stage(name).histogram.add(seconds)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            stages = dict(self.stages)
+            counters = dict(self.counters)
+        return {'time': time.time(), 'buckets': list(self.buckets),
+                'stages': {name: stage.histogram.snapshot() for name, stage in sorted(stages.items())},
+                'counters': dict(sorted(counters.items()))}
+
+    def to_json(self, indent=2):
+        return json.dumps(self.snapshot(), indent=indent)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        name = self.prefix + '_stage_seconds'
+        lines = ['# HELP {} Duration of pipeline stages.'.format(name), '# TYPE {} histogram'.format(name)]
+        for stage, stats in snapshot['stages'].items():
+            total = 0
+            for le, count in zip(list(self.buckets) + ['+Inf'], stats['buckets']):
+                total += count
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, le, total))
+            lines.append('{}_sum{{stage="{}"}} {!r}'.format(name, stage, stats['sum']))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, stats['count']))
+        name = self.prefix + '_stage_recent_seconds'
+        lines += ['# HELP {} Quantiles of the most recent stage durations.'.format(name), '# TYPE {} gauge'.format(name)]
+        for stage, stats in snapshot['stages'].items():
+            for q in ['p50', 'p90', 'p99']:
+                lines.append('{}{{stage="{}",quantile="0.{}"}} {!r}'.format(name, stage, q[1:], stats[q]))
+        name = self.prefix + '_events_total'
+        lines += ['# HELP {} Pipeline event counters.'.format(name), '# TYPE {} counter'.format(name)]
+        for counter, value in snapshot['counters'].items():
+            lines.append('{}{{name="{}"}} {}'.format(name, counter, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # .prom for the Prometheus text format, anything else as JSON, replaced atomically
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        tmp = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        # /metrics in Prometheus text format, /json as JSON, from a daemon thread
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/json'):
+                    body, kind = metrics.to_json().encode(), 'application/json'
+                else:
+                    body, kind = metrics.to_prometheus().encode(), 'text/plain; version=0.0.4'
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+metrics = StageMetrics()
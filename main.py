@@ -2,8 +2,8 @@ import cv2
 import os
 import numpy as np
 from ExtrinsicCalibration import ExCalibrator
-from IntrinsicCalibration import InCalibrator, CalibMode
-from SurroundBirdEyeView import BevGenerator
+from IntrinsicCalibration import InCalibrator, CalibMode, InCalibConfig
+from SurroundBirdEyeView import BevGenerator, BevConfig
 
 
 def runInCalib_1():
@@ -29,9 +29,8 @@ def runInCalib_1():
 
 def runInCalib_2():
     print("Intrinsic Calibration ......")
-    args = InCalibrator.get_args()                      # 获取内参标定args参数
-    args.INPUT_PATH = './IntrinsicCalibration/data/'    # 修改为新的参数
-    calibrator = InCalibrator('fisheye')                # 初始化内参标定器
+    config = InCalibConfig(INPUT_PATH = './IntrinsicCalibration/data/')   # 内参标定参数
+    calibrator = InCalibrator('fisheye', config)        # 初始化内参标定器
     calib = CalibMode(calibrator, 'image', 'auto')      # 选择标定模式
     result = calib()                                    # 开始标定
 
@@ -76,12 +75,10 @@ def runBEV():
     left = cv2.imread('./SurroundBirdEyeView/data/left/left.jpg')
     right = cv2.imread('./SurroundBirdEyeView/data/right/right.jpg')
 
-    args = BevGenerator.get_args()                      # 获取环视鸟瞰args参数
-    args.CAR_WIDTH = 200
-    args.CAR_HEIGHT = 350                               # 修改为新的参数
+    config = BevConfig(CAR_WIDTH = 200, CAR_HEIGHT = 350)   # 环视鸟瞰参数
 
-    bev = BevGenerator(blend=True, balance=True)        # 初始化环视鸟瞰图生成器
-    surround = bev(front, back, left, right)            # 输入前后左右四张原始相机图像 得到拼接后的鸟瞰图
+    with BevGenerator(blend=True, balance=True, config=config) as bev:   # 初始化环视鸟瞰图生成器，结束后关闭其工作线程
+        surround = bev(front, back, left, right)        # 输入前后左右四张原始相机图像 得到拼接后的鸟瞰图
 
     cv2.namedWindow('surround', flags=cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
     cv2.imshow('surround', surround)